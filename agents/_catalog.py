@@ -0,0 +1,89 @@
+import json
+import time
+import asyncio
+import logging
+from agents._stream import iter_items
+
+
+# The only parts of a storefront entry we ever look at.
+FIELDS = ('human_url', 'human_name', 'current_price', 'sale_end')
+
+
+async def storefront(http):
+    '''
+    Price index of the humble store front page, {human_url: entry} for
+    every product that has a current_price.
+    '''
+    url = 'https://www.humblebundle.com/store'
+
+    # There have been no complaints, but this will help them find me if
+    # they have some.
+    headers = {
+        'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
+    }
+
+    index = dict()
+    async with http.get(url, headers=headers, timeout=3) as response:
+        # The page embeds a huge JSON blob, we stream through the HTML and
+        # only decode its entity_lookup_dict, one entry at a time.
+        entries = iter_items(response.content, 'entity_lookup_dict')
+
+        try:
+            async for key, game in entries:
+                if not isinstance(game, dict):
+                    continue
+
+                if game.get('current_price') and game.get('human_url'):
+                    index[game['human_url']] = {
+                        k: game.get(k) for k in FIELDS
+                    }
+
+        except json.JSONDecodeError as e:
+            logging.warn('Humble store JSON load failed: {}'.format(e))
+            return dict()
+
+    return index
+
+
+class Catalog:
+    '''
+    One storefront snapshot shared by the humble agents. Whoever asks first
+    in a `ttl` window fetches it, anyone asking meanwhile waits on that same
+    fetch, and everyone else gets the cached index.
+    '''
+    def __init__(self, *, ttl=1800):
+        self.ttl = ttl
+        self.index = dict()
+        self.fetched = None
+        self.pending = None
+
+    async def snapshot(self, http):
+        fresh = (
+            self.fetched is not None and
+            time.monotonic() - self.fetched < self.ttl
+        )
+        if fresh:
+            return self.index
+
+        if self.pending is None:
+            self.pending = asyncio.ensure_future(storefront(http))
+
+        # Shielded so one impatient caller can't cancel it for the rest.
+        pending = self.pending
+        try:
+            index = await asyncio.shield(pending)
+        finally:
+            if self.pending is pending and pending.done():
+                self.pending = None
+
+        # An empty index means the fetch went wrong, let the next caller
+        # try again instead of caching nothing for `ttl` seconds.
+        if index and self.index is not index:
+            self.index = index
+            self.fetched = time.monotonic()
+
+        return index
+
+
+# Module level, so every agent importing this shares the one snapshot.
+catalog = Catalog()
@@ -0,0 +1,27 @@
+class Validators:
+    '''
+    ETag and Last-Modified from the last full response of a feed, sent back
+    on the next poll so an unchanged feed costs us a 304 and nothing else.
+    '''
+    def __init__(self):
+        self.etag = None
+        self.modified = None
+
+    def headers(self):
+        '''Validators for a conditional GET, if we have any yet.'''
+        headers = dict()
+
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.modified:
+            headers['If-Modified-Since'] = self.modified
+
+        return headers
+
+    def remember(self, response):
+        '''
+        Keep the validators of a 200 response for next time. Callers check
+        the status first, an error page's validators are worthless.
+        '''
+        self.etag = response.headers.get('ETag')
+        self.modified = response.headers.get('Last-Modified')
@@ -0,0 +1,142 @@
+import json
+import codecs
+
+
+# Shared decoder, raw_decode doesn't keep any state between calls.
+decoder = json.JSONDecoder()
+
+WHITESPACE = ' \t\n\r'
+
+# Anything that can carry on a number, '4444.' or '-5e' might be one cut
+# off at the end of a chunk.
+NUMBER = '0123456789+-.eE'
+
+
+class StreamReader:
+    '''
+    Buffers a chunked aiohttp body (anything with an async read(n)) as text
+    and lets us pull JSON values out of it one at a time. Only the part we
+    haven't consumed yet is ever held in memory.
+    '''
+    def __init__(self, content, *, chunk_size=65536, encoding='utf-8'):
+        self.content = content
+        self.chunk_size = chunk_size
+        self.decode = codecs.getincrementaldecoder(encoding)('replace').decode
+
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    async def fill(self):
+        '''Read another chunk, returns False once the body is exhausted.'''
+        if self.eof:
+            return False
+
+        chunk = await self.content.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            self.buf += self.decode(b'', final=True)
+            return False
+
+        # Throw away what we've already consumed before growing.
+        self.buf = self.buf[self.pos:] + self.decode(chunk)
+        self.pos = 0
+
+        return True
+
+    async def seek(self, needle):
+        '''Move to just past the next occurrence of needle.'''
+        while True:
+            found = self.buf.find(needle, self.pos)
+            if found != -1:
+                self.pos = found + len(needle)
+                return True
+
+            # Keep enough of a tail that a split needle still matches.
+            self.pos = max(self.pos, len(self.buf) - len(needle))
+            if not await self.fill():
+                return False
+
+    async def peek(self):
+        '''Next non whitespace character, without consuming it.'''
+        while True:
+            buf = self.buf
+            while self.pos < len(buf) and buf[self.pos] in WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+
+            if not await self.fill():
+                return ''
+
+    async def expect(self, char):
+        if await self.peek() != char:
+            raise json.JSONDecodeError(
+                'Expected {!r}'.format(char), self.buf, self.pos
+            )
+        self.pos += 1
+
+    async def value(self):
+        '''Decode exactly one JSON value, reading more as needed.'''
+        await self.peek()
+
+        while True:
+            try:
+                obj, end = decoder.raw_decode(self.buf, self.pos)
+
+                # A number is only done once something that can't be part
+                # of it follows. raw_decode happily stops at '4444' in
+                # '4444.' when the rest is still in the next chunk.
+                number = type(obj) in (int, float)
+                cut = end == len(self.buf) or self.buf[end] in NUMBER
+                if self.eof or not (number and cut):
+                    self.pos = end
+                    return obj
+
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+
+            await self.fill()
+
+
+async def iter_items(content, key, **kwargs):
+    '''
+    Stream the members of the array or object stored under `key` in a JSON
+    body without loading the whole document. Arrays yield their elements,
+    objects yield (name, value) pairs. Yields nothing if the key is missing.
+    '''
+    reader = StreamReader(content, **kwargs)
+
+    if not await reader.seek(json.dumps(key)):
+        return
+
+    await reader.expect(':')
+
+    opening = await reader.peek()
+    if opening not in '[{':
+        raise json.JSONDecodeError(
+            '{} is not an array or object'.format(key), reader.buf, reader.pos
+        )
+
+    closing = ']' if opening == '[' else '}'
+    reader.pos += 1
+
+    while True:
+        char = await reader.peek()
+
+        if char == closing:
+            return
+        elif char == ',':
+            reader.pos += 1
+            continue
+        elif char == '':
+            raise json.JSONDecodeError('Truncated', reader.buf, reader.pos)
+
+        if opening == '[':
+            yield await reader.value()
+        else:
+            name = await reader.value()
+            await reader.expect(':')
+            yield name, await reader.value()
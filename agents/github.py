@@ -1,98 +1,247 @@
+import time
 import aiohttp
 import asyncio
-import msgpack
 import logging
 from datetime import timedelta
-from socket import create_connection
+from collections import defaultdict
 import config
 
 
-async def getCommits(user, repo):
+# How many recent commit ids we keep per repo, on top of the watermark.
+RECENT = 200
+
+
+class RateLimit:
+    '''
+    Tracks GitHub's X-RateLimit-* headers and spaces requests out so the
+    remaining quota lasts until the window resets. The closer we get to
+    `reserve` requests left, the longer we wait between them.
+    '''
+    def __init__(self, *, reserve=100):
+        self.reserve = reserve
+        self.remaining = None
+        self.reset = None
+        self.lock = asyncio.Lock()
+
+    def update(self, headers):
+        # Both or neither, delay() needs the pair.
+        try:
+            remaining = int(headers['X-RateLimit-Remaining'])
+            reset = int(headers['X-RateLimit-Reset'])
+        except (KeyError, ValueError):
+            return
+
+        self.remaining, self.reset = remaining, reset
+
+    def delay(self):
+        '''Seconds to wait before the next request.'''
+        if self.remaining is None:
+            return 0
+
+        window = max(self.reset - time.time(), 0)
+        if self.remaining <= self.reserve:
+            # Out of quota, sit the rest of the window out.
+            return window + 1
+
+        return window / (self.remaining - self.reserve)
+
+    async def wait(self):
+        # One at a time, so the delays actually space requests out.
+        async with self.lock:
+            await asyncio.sleep(self.delay())
+
+
+async def getCommits(http, user, repo, *, state=None, ratelimit=None):
     '''
     Simple method to retrieve the commits for a users repository on github.
+
+    `state` is this repo's {'etag', 'since'} from the last check, it gets
+    updated in place. Returns None if nothing changed since then (a 304,
+    which GitHub doesn't count against our quota).
     '''
-    async with aiohttp.ClientSession() as session:
-        # Hard code the formatting.
-        url = f'https://api.github.com/repos/{user}/{repo}/commits'
-
-        # The rate limiting is much better for authenticated users.
-        auth = {
-            'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
-            'Authorization': 'token {}'.format(config.github)
-        }
+    if state is None:
+        state = dict()
+
+    # Hard code the formatting.
+    url = f'https://api.github.com/repos/{user}/{repo}/commits'
+
+    # The rate limiting is much better for authenticated users.
+    auth = {
+        'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
+        'Authorization': 'token {}'.format(config.github)
+    }
+
+    if state.get('etag'):
+        auth['If-None-Match'] = state['etag']
+
+    # Only what's newer than the newest commit we've seen.
+    params = dict()
+    if state.get('since'):
+        params['since'] = state['since']
+
+    async with http.get(url, headers=auth, params=params) as response:
+        if ratelimit is not None:
+            ratelimit.update(response.headers)
+
+        if response.status == 304:
+            return None
 
-        async with session.get(url, headers=auth) as response:
-            # Ha.
-            data = [
-                {
-                    'id': commit['sha'],
-                    'author': commit['commit']['author']['name'],
-                    'message': commit['commit']['message'],
-                    'date': commit['commit']['committer']['date'],
-                    'url': commit['html_url']
-                }
-                for commit in await response.json()
-            ]
+        # Missing repo, bad token, rate limited..nothing to see.
+        if response.status != 200:
+            logging.warn('GIT: {}/{} returned {}'.format(
+                user, repo, response.status
+            ))
+            return []
 
-            return data
+        # Ha.
+        data = [
+            {
+                'id': commit['sha'],
+                'author': commit['commit']['author']['name'],
+                'message': commit['commit']['message'],
+                'date': commit['commit']['committer']['date'],
+                'url': commit['html_url']
+            }
+            for commit in await response.json()
+        ]
 
+        state['etag'] = response.headers.get('ETag')
+        if data:
+            # ISO8601 in UTC, so comparing strings is fine.
+            state['since'] = max(x['date'] for x in data)
+
+        return data
+
+
+def knownCommits(stored):
+    '''Commit ids we've seen for a repo, from its stored state doc.'''
+    known = set(stored.get('recent', []))
+
+    # Old style docs kept every commit, until we next write to them.
+    known.update(x['id'] for x in stored.get('commits', []))
+
+    return known
+
+
+async def checkRepo(http, persist, repo, limit, ratelimit, state, stored):
+    '''
+    Look for new commits on one 'user/repo', at most `limit` of these run
+    at once. `stored` is the repo's doc from db.git, or None if we've never
+    looked at it before. Returns the commits worth telling people about.
+    '''
+    # Pick up where we left off before a restart.
+    if stored and not state.get('since'):
+        state['since'] = stored.get('last_date')
+
+    async with limit:
+        logging.debug('GIT: {}'.format(repo))
+
+        # Request the data, paced to the rate limit.
+        await ratelimit.wait()
+
+        user, name = repo.split('/', 1)
+        try:
+            data = await getCommits(
+                http, user, name, state=state, ratelimit=ratelimit
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logging.warn('GIT: {} failed: {}'.format(repo, e))
+            return []
+
+    # Nothing changed.
+    if not data:
+        return []
+
+    # Thanks to since= this is only ever a handful of commits.
+    known = knownCommits(stored) if stored else set()
+    new = [commit for commit in data if commit['id'] not in known]
+
+    # One write per repo, whenever the buffer gets to it. Newest last so
+    # the slice keeps the most recent ones.
+    if new:
+        newest = max(new, key=lambda x: x['date'])
+        persist.update(
+            'git',
+            {'id': repo},
+            {
+                '$push': {'recent': {
+                    '$each': [x['id'] for x in reversed(new)],
+                    '$slice': -RECENT,
+                }},
+                '$max': {'last_date': newest['date']},
+                '$set': {'last_sha': newest['id']},
+                '$unset': {'commits': ''},
+            },
+            upsert=True
+        )
+
+    # Prevents spam on first lookup of repo.
+    if not stored:
+        return []
+
+    return new
+
+
+async def agent(db, *, http, notify, persist,
+                freq=timedelta(hours=12), concurrency=8):
+    # Kept between cycles: quota left, and per repo ETag/high-water mark.
+    ratelimit = RateLimit()
+    states = defaultdict(dict)
 
-async def agent(db, *, freq=timedelta(hours=12)):
     while True:
         logging.debug('Checking for new commits to known repositories..')
+
+        # Every repo anybody watches, and who is watching it. Popular repos
+        # only get fetched once a cycle this way.
+        watchers = defaultdict(list)
+
         qfilter = {'user': 1, 'git': 1}
         async for sub in db.subscribers.find({}, qfilter):
-            for info in sub['git']:
-                logging.debug('GIT: {}'.format(info))
+            for info in sub.get('git', []):
+                repo = '{user}/{repo}'.format(**info)
+                if sub['user'] not in watchers[repo]:
+                    watchers[repo].append(sub['user'])
+
+        # Everything we know about them, in one query.
+        repos = list(watchers)
+        qfilter = {'id': 1, 'recent': 1, 'last_date': 1, 'commits.id': 1}
+        stored = {
+            doc['id']: doc
+            async for doc in db.git.find({'id': {'$in': repos}}, qfilter)
+        }
 
-                # Known repository specific commits.
-                known = await db.git.distinct(
-                    'commits.id',
-                    {'id': '{user}/{repo}'.format(**info)}
+        # All at once, bounded so we don't hammer GitHub.
+        limit = asyncio.Semaphore(concurrency)
+        results = await asyncio.gather(*(
+            checkRepo(
+                http, persist, repo, limit, ratelimit,
+                states[repo], stored.get(repo)
+            )
+            for repo in repos
+        ))
+
+        for repo, new in zip(repos, results):
+            if not new:
+                continue
+
+            digest = ['\nNew commit(s) on {}'.format(repo)]
+            for commit in new:
+                msg = '{}\n{}'.format(
+                    commit['message'],
+                    commit['url']
                 )
+                digest.append(msg)
+
+            payload = {
+                'to': watchers[repo],
+                'msg': '\n\n'.join(digest),
+                'type': 'git',
+            }
+
+            logging.debug('payload={}'.format(payload))
 
-                # Request the data.
-                data = await getCommits(info['user'], info['repo'])
-
-                digest = [
-                    '\nNew commit(s) on {}/{}'.format(
-                        info['user'], info['repo']
-                    )
-                ]
-                for commit in data:
-                    if commit['id'] not in known:
-                        # Prevents spam on first lookup of repo.
-                        if len(known) >= 1:
-                            msg = '{}\n{}'.format(
-                                commit['message'],
-                                commit['url']
-                            )
-                            # Using listcomps would look neater but
-                            # also wouldn't be PEP8 compliant.
-                            # The things I do for 79 characters.
-                            digest.append(msg)
-
-                        result = await db.git.update_one(
-                            {'id': '{user}/{repo}'.format(**info)},
-                            {'$push': {'commits': commit}},
-                            upsert=True
-                        )
-
-                        logging.debug('Upsert: {}'.format(result))
-
-                if len(digest) >= 2:
-                    payload = {
-                        'to': sub['user'],
-                        'msg': '\n\n'.join(digest),
-                        'type': 'git',
-                    }
-
-                    logging.debug('payload={}'.format(payload))
-
-                    # Pass the infomration to Jarvis.
-                    sock = create_connection(('192.168.1.200', 8888))
-                    sock.send(msgpack.packb(payload))
-                    sock.close()
+            # Pass the infomration to Jarvis.
+            notify.send(payload)
 
         logging.debug(
             'agent.github sleeping for {}'.format(freq.total_seconds())
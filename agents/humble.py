@@ -1,63 +1,24 @@
-import json
-import aiohttp
 import logging
 import asyncio
-import msgpack
-from socket import create_connection
 from datetime import timedelta
+from agents._catalog import catalog
 
 
-async def humbleScrape():
+async def humbleScrape(http):
     '''
-    Scrape the humble store front page looking for
+    Look through the shared storefront snapshot for
     free games.
     '''
-    url = 'https://www.humblebundle.com/store'
+    index = await catalog.snapshot(http)
+    return [game for game in index.values() if 0.0 in game['current_price']]
 
-    # What string do we look for?
-    jsonIdentifier = '"page": {'
 
-    async with aiohttp.ClientSession() as session:
-        # There have been no complaints, but this will help them find me if
-        # they have some.
-        headers = {
-            'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
-        }
-        async with session.get(url, headers=headers, timeout=3) as response:
-            page_src = await response.text()
-
-        for line in page_src.splitlines():
-            # So...sometimes this string isn't in the page? What?
-            if jsonIdentifier in line:
-                # Chop off leading whitespace.
-                line = line.lstrip()
-
-                # Chop off 'page: ', which is 6 characters.
-                shop = json.loads(line[8:-1])['entity_lookup_dict']
-
-                # We're done here, get out of loop.
-                break
-
-        try:
-            games = [
-                game for game in shop.values()
-                if game.get('current_price') is not None
-            ]
-
-            freebies = [
-                game for game in games if 0.0 in game['current_price']
-            ]
-
-            return freebies
-        except UnboundLocalError:
-            return []
-
-
-async def agent(db, *, freq=timedelta(hours=5)):
+async def agent(db, *, http, notify, persist,
+                freq=timedelta(hours=5)):
     while True:
         logging.debug('Checking humblebundle..')
         try:
-            free_games = await humbleScrape()
+            free_games = await humbleScrape(http)
         except asyncio.TimeoutError as e:
             logging.warn('Timed out during free game check!')
             continue
@@ -78,7 +39,8 @@ async def agent(db, *, freq=timedelta(hours=5)):
 
                 logging.debug('{} is new..'.format(game['human_name']))
 
-                await db.games.update_one(
+                persist.update(
+                    'games',
                     {'human_url': game['human_url']},
                     {
                         # Flymake was complaining now it's not.
@@ -102,9 +64,7 @@ async def agent(db, *, freq=timedelta(hours=5)):
                 logging.debug('payload={}'.format(payload))
 
                 # Pass the infomration to Jarvis.
-                sock = create_connection(('192.168.1.200', 8888))
-                sock.send(msgpack.packb(payload))
-                sock.close()
+                notify.send(payload)
 
         # PEP8 pls
         logging.debug(
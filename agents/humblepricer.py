@@ -1,13 +1,12 @@
-import aiohttp
 import json
+import aiohttp
 import asyncio
 import logging
 from datetime import timedelta
-from socket import create_connection
-import msgpack
+from agents._catalog import catalog
 
 
-async def humbleScrape(game_name):
+async def humbleScrape(http, game_name):
     '''
     Scrape the humble store front page looking for
     free games.
@@ -15,41 +14,77 @@ async def humbleScrape(game_name):
     # huehue
     url = 'https://www.humblebundle.com/store/' + game_name
 
-    async with aiohttp.ClientSession() as session:
-        # There have been no complaints, but this will help them find me if
-        # they have some.
-        headers = {
-            'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
-        }
-        async with session.get(url, headers=headers, timeout=3) as response:
-            page_src = await response.text()
+    # There have been no complaints, but this will help them find me if
+    # they have some.
+    headers = {
+        'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
+    }
+    async with http.get(url, headers=headers, timeout=3) as response:
+        page_src = await response.text()
+
+    for line in page_src.splitlines():
+        # So...sometimes this string isn't in the page? What?
+        if 'products_json' in line: #: [{' in line:
+            # Game data, there is only ever 1
+            line = line.lstrip()
+
+            # Fight me about it.
+            game = json.loads(line[line.find('[{'):-1])[0]
+
+            # We're done.
+            return game
+
 
-        for line in page_src.splitlines():
-            # So...sometimes this string isn't in the page? What?
-            if 'products_json' in line: #: [{' in line:
-                # Game data, there is only ever 1
-                line = line.lstrip()
+async def fetchProduct(http, name, limit):
+    '''humbleScrape a product page, at most `limit` at a time.'''
+    async with limit:
+        try:
+            return await humbleScrape(http, name)
+        except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+            logging.warn('humblepricer failed on {}: {!r}'.format(name, e))
+            return None
 
-                # Fight me about it.
-                game = json.loads(line[line.find('[{'):-1])[0]
 
-                # We're done.
-                return game
+async def snapshot(http):
+    '''The shared storefront index, or an empty one if we can't get it.'''
+    try:
+        return await catalog.snapshot(http)
+    except (asyncio.TimeoutError, aiohttp.ClientError) as e:
+        logging.warn('humblepricer storefront failed: {!r}'.format(e))
+        return dict()
 
 
-async def agent(db, *, freq=timedelta(hours=5)):
+async def agent(db, *, http, notify, persist,
+                freq=timedelta(hours=5), concurrency=8):
     while True:
         logging.debug('Checking for sales..')
 
         # Just for character count and easier to modify later.
         query = {'sales_watch': {'$exists': True}}
         qfilter = {'user': 1, 'sales_watch': 1}
-        async for sub in db.subscribers.find(query, qfilter):
+        subs = [sub async for sub in db.subscribers.find(query, qfilter)]
+
+        # Each product once, no matter how many people watch it.
+        names = list({
+            watching['name'] for sub in subs
+            for watching in sub['sales_watch']
+        })
+
+        # Most watched games are priced on the storefront already, only
+        # scrape product pages for the ones that aren't.
+        index = await snapshot(http)
+        products = {name: index[name] for name in names if name in index}
+        missing = [name for name in names if name not in products]
+
+        limit = asyncio.Semaphore(concurrency)
+        products.update(zip(missing, await asyncio.gather(
+            *(fetchProduct(http, name, limit) for name in missing)
+        )))
+
+        for sub in subs:
             for watching in sub['sales_watch']:
-                try:
-                    check = await humbleScrape(watching['name'])
-                except asyncio.TimeoutError as e:
-                    logging.warn('Timed out during humblepricer!')
+                check = products.get(watching['name'])
+                if check is None:
                     continue
 
                 price, wanted = check['current_price'][0], watching['price']
@@ -61,11 +96,10 @@ async def agent(db, *, freq=timedelta(hours=5)):
                     logging.debug('Found good sale: {}'.format(watching))
 
                     # Remove the entry from the DB. Bad practice? Yep.
-                    query.update({'user': sub['user']})
                     result = await db.subscribers.update_one(
-                        query, {'$pull':
-                                {'sales_watch':
-                                 {'name': check['human_url']}}}
+                        {'user': sub['user']},
+                        {'$pull': {'sales_watch':
+                                   {'name': check['human_url']}}}
                     )
 
                     # I feel dirty.
@@ -92,9 +126,7 @@ async def agent(db, *, freq=timedelta(hours=5)):
                     }
 
                     # Pass the payload to Jarvis.
-                    sock = create_connection(('192.168.1.200', 8888))
-                    sock.send(msgpack.packb(payload))
-                    sock.close()
+                    notify.send(payload)
 
         # Reeeeee, 79 characters.
         logging.debug(
@@ -1,126 +1,222 @@
-import aiohttp
+import re
 import json
 import asyncio
+import hashlib
 import logging
 from datetime import timedelta, datetime
-from socket import create_connection
-import msgpack
+from collections import defaultdict
 from concurrent.futures import TimeoutError
+from agents._conditional import Validators
 
 
-async def get_warframe():
+# What `warframe: True` subscribers without a watch list of their own get.
+DEFAULT_WATCH = {
+    # 'Alertium': 'Nitain Extract',
+    'OrokinCatalystBlueprint': 'Orokin Catalyst Blueprint',
+    'OrokinReactorBlueprint': 'Orokin Reactor Blueprint',
+    # 'Eventium': 'Synthula',
+    # 'EnemyArmorReductionAuraMod': 'Corrosive Projection',
+}
+
+
+def itemName(item):
+    '''Readable name for an ItemType tail, 'FooBarBlueprint' -> 'Foo Bar..'.'''
+    if item in DEFAULT_WATCH:
+        return DEFAULT_WATCH[item]
+
+    return ' '.join(re.findall(r'[A-Z]+[a-z0-9]*|[a-z0-9]+', item)) or item
+
+
+class Matcher:
+    '''
+    Every subscriber's watch list compiled into one lookup, keyed on the
+    last part of a reward's ItemType path. Matching a reward is a single
+    dict hit no matter how many users or patterns there are.
+    '''
+    def __init__(self):
+        self.index = defaultdict(set)
+
+    @classmethod
+    async def load(cls, db):
+        matcher = cls()
+
+        query = {'warframe': True}
+        qfilter = {'user': 1, 'warframe_watch': 1}
+        async for sub in db.subscribers.find(query, qfilter):
+            watch = sub.get('warframe_watch') or DEFAULT_WATCH
+            for item in watch:
+                matcher.index[item].add(sub['user'])
+
+        return matcher
+
+    def match(self, item_type):
+        '''Users who want a reward, given its full ItemType path.'''
+        return self.index.get(item_type.rsplit('/', 1)[-1], ())
+
+
+class WorldState(Validators):
+    '''
+    What we saw on the last worldState poll: validators for a conditional
+    request, a hash of the raw body and the alert ids it contained. Lets
+    us skip unchanged documents and only look at alerts we haven't yet.
+    '''
+    def __init__(self):
+        super().__init__()
+        self.digest = None
+
+        # Alert ids as of the last document we parsed.
+        self.alerts = set()
+
+    def changed(self, response, body):
+        '''Remember this response, True if the body differs from last time.'''
+        self.remember(response)
+
+        digest = hashlib.sha1(body).digest()
+        if digest == self.digest:
+            return False
+
+        self.digest = digest
+        return True
+
+
+# Module level, so it survives between polls.
+state = WorldState()
+
+
+async def get_warframe(http):
+    '''
+    Rewards of alerts that are new since the last poll, or None if the
+    world state hasn't changed at all.
+    '''
     # URL for JSON data.
     url = "http://content.warframe.com/dynamic/worldState.php"
 
-    # Watched items.
-    watched = {
-        # 'Alertium': 'Nitain Extract',
-        'OrokinCatalystBlueprint': 'Orokin Catalyst Blueprint',
-        'OrokinReactorBlueprint': 'Orokin Reactor Blueprint',
-        # 'Eventium': 'Synthula',
-        # 'EnemyArmorReductionAuraMod': 'Corrosive Projection',
+    headers = {
+        'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)'
     }
+    headers.update(state.headers())
+
+    async with http.get(url, headers=headers, timeout=10) as response:
+        if response.status == 304:
+            return None
+
+        # An error page is no snapshot, keep the one we have.
+        if response.status != 200:
+            logging.warn('Warframe request got a {}'.format(response.status))
+            return None
+
+        # Most polls return the exact same document, don't parse it again.
+        body = await response.read()
+        if not state.changed(response, body):
+            return None
+
+        data = json.loads(body)
+
+        # Only alerts we didn't see last time need looking at.
+        previous = state.alerts
+        state.alerts = {alert['_id']['$oid'] for alert in data['Alerts']}
+
+        results = []
+        for alert in data['Alerts']:
+            # Shorthand
+            mission_rewards = alert['MissionInfo']['missionReward']
+            alert_id = alert['_id']['$oid']
+
+            if alert_id in previous:
+                continue
+
+            # Split into two lines, PEP8 pls.
+            expires = int(alert['Expiry']['$date']['$numberLong']) / 1000
+            expires = datetime.fromtimestamp(expires)
+
+            # Is it a counted or no? We don't concern ourselves with
+            # credits-only alerts either way.
+            rewards = [
+                item['ItemType']
+                for item in mission_rewards.get('countedItems', [])
+            ]
+            rewards.extend(mission_rewards.get('items', []))
+
+            for item in rewards:
+                results.append(
+                    {
+                        'id': alert_id,
+                        'type': item,
+                        'expires': expires
+                    }
+                )
 
-    async with aiohttp.ClientSession() as session:
-        headers = {
-            'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)'
-        }
-
-        async with session.get(url, headers=headers, timeout=10) as response:
-            data = json.loads(await response.text())
-
-            results = []
-            for alert in data['Alerts']:
-                # Shorthand
-                mission_rewards = alert['MissionInfo']['missionReward']
-                alert_id = alert['_id']['$oid']
-
-                # Split into two lines, PEP8 pls.
-                expires = int(alert['Expiry']['$date']['$numberLong']) / 1000
-                expires = datetime.fromtimestamp(expires)
-
-                # TODO: clean all this up.
-                # Is it a counted or no?
-                field = mission_rewards.get('countedItems')
-                if field:
-                    for item in field:
-                        item_name = item['ItemType'].split('/')[-1]
-                        if any(thing in item['ItemType'] for thing in watched.keys()):
-                            results.append(
-                                {
-                                    'id': alert_id,
-                                    'item': item_name,
-                                    'name': watched[item_name],
-                                    'expires': expires
-                                }
-                            )
-                else:
-                    # We don't concern ourselves with credits-only alerts.
-                    if 'items' not in mission_rewards.keys():
-                        continue
-
-                    for item in mission_rewards['items']:
-                        item_name = item.split('/')[-1]
-                        if any(thing in item for thing in watched.keys()):
-                            results.append(
-                                {
-                                    'id': alert_id,
-                                    'item': item_name,
-                                    'name': watched[item_name],
-                                    'expires': expires
-                                }
-                            )
-
-            return results
-
-
-async def agent(db, *, freq=timedelta(minutes=5)):
+        return results
+
+
+async def agent(db, *, http, notify, persist,
+                freq=timedelta(minutes=5)):
     while True:
         logging.debug('Checking Warframe Alerts..')
 
         try:
-            check = await get_warframe()
+            check = await get_warframe(http)
         except TimeoutError:
             logging.error('Warframe agent timed out..resetting.')
             await asyncio.sleep(5)
             continue
 
         if check:
-            query = {'warframe': {'$exists': True}}
-            qfilter = {'user': 1, 'warframe': 1}
-
-            # Message prefix.
-            msg = [
-                'Warframe Alert!'
-            ]
+            matcher = await Matcher.load(db)
+
+            # Rewards somebody actually wants, each (id, item) once.
+            candidates = dict()
+            for reward in check:
+                users = matcher.match(reward['type'])
+                if users:
+                    item = reward['type'].rsplit('/', 1)[-1]
+                    candidates[(reward['id'], item)] = (reward, users)
+
+            # One query for which of these we've already sent.
+            seen = set()
+            if candidates:
+                query = {'id': {'$in': list({x[0] for x in candidates})}}
+                async for doc in db.warframe.find(query, {'id': 1, 'item': 1}):
+                    seen.add((doc['id'], doc['item']))
+
+            # user -> lines of their message.
+            lines = defaultdict(list)
 
             # Alert processing.
-            for alert in check:
-                pattern = {'item': alert['item'], 'id': alert['id']}
-                if await db.warframe.find_one(pattern):
+            for (alert_id, item), (reward, users) in candidates.items():
+                if (alert_id, item) in seen:
                     continue
 
-                # If it's new, get the message ready.
-                msg.append('{name} - Expires: {expires}'.format(**alert))
-                await db.warframe.insert_one(alert)
-
-            # Message sending.
-            async for sub in db.subscribers.find(query, qfilter):
-                if len(msg) > 1 and sub['warframe'] is True:
-                    # Payload.
-                    payload = {
-                        # TODO We should be able to pass a list of users
-                        # rather than do it one at a time. It would reduce log
-                        # entries and just be "cleaner" in my opinion.
-                        'to': sub['user'],
-                        'msg': '\n'.join(msg),
-                        'type': 'warframe',
-                    }
+                alert = {
+                    'id': alert_id,
+                    'item': item,
+                    'name': itemName(item),
+                    'expires': reward['expires'],
+                }
 
-                    # Pass the payload to Jarvis.
-                    sock = create_connection(('192.168.1.200', 8888))
-                    sock.send(msgpack.packb(payload))
-                    sock.close()
+                # If it's new, get the message ready.
+                line = '{name} - Expires: {expires}'.format(**alert)
+                for user in users:
+                    lines[user].append(line)
+
+                # Queued, these all go out in one bulk write.
+                persist.insert('warframe', alert)
+
+            # Message sending, one payload per distinct message.
+            audience = defaultdict(list)
+            for user, msg in lines.items():
+                audience[tuple(msg)].append(user)
+
+            for msg, users in audience.items():
+                # Payload.
+                payload = {
+                    'to': users,
+                    'msg': '\n'.join(('Warframe Alert!',) + msg),
+                    'type': 'warframe',
+                }
+
+                # Pass the payload to Jarvis.
+                notify.send(payload)
 
         # Reeeeee, 79 characters.
         logging.debug(
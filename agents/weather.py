@@ -1,101 +1,277 @@
 import json
+import heapq
 import aiohttp
 import logging
 import asyncio
-import msgpack
-from socket import create_connection
-from datetime import timedelta
+from datetime import timedelta, datetime, timezone
+from collections import defaultdict
+from agents._stream import iter_items
+from agents._conditional import Validators
 
 
-async def getWeather(same):
+class AlertFeed(Validators):
     '''
-    Give it a postal code and it'll give you JSON representing the weather
-    for that postcode.
+    Remembers the last NWS snapshot so we can make conditional requests
+    and only hand back the alerts that changed since the previous poll.
+    '''
+    def __init__(self):
+        super().__init__()
+
+        # Alert ids as of the last 200 response.
+        self.snapshot = set()
+
+    def update(self, response, current):
+        '''
+        Swap in a fresh snapshot of alert ids and return the set of ids that
+        are no longer active.
+        '''
+        self.remember(response)
+
+        removed = self.snapshot - current
+        self.snapshot = current
 
+        return removed
+
+
+def trim(feature):
     '''
-    # URL for PEP8
-    url = 'https://api.weather.gov/alerts?active=1'
+    Keep only what we actually use from a GeoJSON feature. The geometry
+    is by far the biggest part and we never look at it.
+    '''
+    props = feature['properties']
 
-    # Now we can do this.
-    async with aiohttp.ClientSession() as session:
-        # There have been no complaints, but this will help them find me if
-        # they have some. PS I love you NWS
-        headers = {
-            'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
+    return {
+        'properties': {
+            'id': props['id'],
+            'geocode': {'SAME': props['geocode'].get('SAME', [])},
+            'severity': props.get('severity'),
+            'headline': props.get('headline'),
+            'description': props.get('description'),
+            'expires': props.get('expires'),
         }
+    }
+
+
+class SeenAlerts:
+    '''
+    Alert ids we've already handled, held in memory so the hot path never
+    asks Mongo. Entries fall out once the alert itself expires (plus some
+    grace), and the whole thing is capped at `limit` entries.
+    '''
+    def __init__(self, *, limit=50000, grace=timedelta(hours=6),
+                 default_ttl=timedelta(days=2)):
+        self.limit = limit
+        self.grace = grace
+        self.default_ttl = default_ttl
+        self.loaded = False
+
+        # id -> expiry, and a heap of (expiry, id) to evict in order.
+        self.ids = dict()
+        self.heap = list()
+
+    def __contains__(self, alert_id):
+        return alert_id in self.ids
 
+    def __len__(self):
+        return len(self.ids)
+
+    def _expiry(self, expires):
+        '''NWS gives us ISO8601, fall back to a default TTL if it doesn't.'''
         try:
-            async with session.get(url, headers=headers) as response:
-                request = await response.text()
+            expires = datetime.strptime(expires, '%Y-%m-%dT%H:%M:%S%z')
+        except (TypeError, ValueError):
+            return datetime.now(timezone.utc) + self.default_ttl
+
+        return expires + self.grace
+
+    def add(self, alert):
+        alert_id = alert['properties']['id']
+        if alert_id in self.ids:
+            return
+
+        expiry = self._expiry(alert['properties'].get('expires'))
+        self.ids[alert_id] = expiry
+        heapq.heappush(self.heap, (expiry, alert_id))
+
+        # Bounded, the soonest to expire go first.
+        while len(self.ids) > self.limit:
+            self._pop()
+
+    def _pop(self):
+        expiry, alert_id = heapq.heappop(self.heap)
+        del self.ids[alert_id]
+
+    def evict(self, now=None):
+        '''Drop everything that has expired.'''
+        if now is None:
+            now = datetime.now(timezone.utc)
 
-                # Docs say aiohttp json() should use this by default
-                # but it fails because mimetype without it..Weird
-                try:
-                    request = json.loads(request)['features']
-                except json.decoder.JSONDecodeError as e:
-                    logging.warn('Weather JSON load failed: {}'.format(e))
-                    return []
+        while self.heap and self.heap[0][0] <= now:
+            self._pop()
 
-        except aiohttp.client_exceptions.ClientConnectorError as e:
-            logging.warn('Weather request failed: {}'.format(e))
+    async def load(self, db):
+        '''One time warm up from what we've stored before.'''
+        qfilter = {'properties.id': 1, 'properties.expires': 1}
+        async for alert in db.alerts.find({}, qfilter):
+            self.add(alert)
 
-            # We'll just default to nothing. For now.
-            return []
+        self.evict()
+        self.loaded = True
 
-    # Seriously forgive me padre, pls.
-    return [x for x in request
-            if same in x['properties']['geocode']['SAME']]
+        logging.debug('Loaded {} seen weather alerts'.format(len(self)))
 
 
-async def agent(db, *, freq=timedelta(minutes=5)):
+# Shared between cycles, that's the whole point.
+feed = AlertFeed()
+seen = SeenAlerts()
+
+
+async def getWeather(http):
+    '''
+    Fetch the active NWS alerts feed and return the alerts added since the
+    last poll, indexed by SAME code. Returns None if the feed hasn't changed.
+
+    '''
+    # URL for PEP8
+    url = 'https://api.weather.gov/alerts?active=1'
+
+    # There have been no complaints, but this will help them find me if
+    # they have some. PS I love you NWS
+    headers = {
+        'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
+    }
+    headers.update(feed.headers())
+
+    # One alert can cover many SAME codes.
+    index = defaultdict(list)
+    current = set()
+    added = 0
+
+    # The timeout covers streaming the whole body too, and during a big
+    # outbreak the feed runs to tens of megabytes. Give it more than the
+    # shared client's default.
+    try:
+        async with http.get(url, headers=headers, timeout=180) as response:
+            # Nothing changed, don't bother parsing anything.
+            if response.status == 304:
+                return None
+
+            # An error page is no snapshot, keep the one we have.
+            if response.status != 200:
+                logging.warn('Weather request got a {}'.format(
+                    response.status
+                ))
+                return {}
+
+            # The feed can be huge during outbreaks, so we stream it one
+            # feature at a time rather than loading the whole document.
+            features = iter_items(response.content, 'features')
+
+            try:
+                async for feature in features:
+                    alert = trim(feature)
+                    alert_id = alert['properties']['id']
+                    current.add(alert_id)
+
+                    # Only the delta goes to the matcher.
+                    if alert_id in feed.snapshot:
+                        continue
+
+                    added += 1
+                    for same in alert['properties']['geocode']['SAME']:
+                        index[same].append(alert)
+
+            except json.decoder.JSONDecodeError as e:
+                logging.warn('Weather JSON load failed: {}'.format(e))
+                return {}
+
+            removed = feed.update(response, current)
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        logging.warn('Weather request failed: {!r}'.format(e))
+
+        # We'll just default to nothing. For now.
+        return {}
+
+    logging.debug('Weather delta: +{} -{}'.format(added, len(removed)))
+
+    return index
+
+
+async def agent(db, *, http, notify, persist,
+                freq=timedelta(minutes=5)):
     while True:
         logging.debug('Checking the weather..')
-        qfilter = {'user': 1, 'same_codes': 1, 'filter': 1}
-        async for sub in db.subscribers.find({}, qfilter):
-            for location in sub['same_codes']:
-                data = await getWeather(location)
 
-                # Just stop here if no alerts.
-                if len(data) is 0:
-                    continue
+        # Single download per cycle, no matter how many subscribers. Only
+        # alerts new since the last poll come back, None if unchanged.
+        index = await getWeather(http)
+
+        # Only touch Mongo for this once, after that it's all in memory.
+        if not seen.loaded:
+            await seen.load(db)
+
+        seen.evict()
+
+        if index:
+            # Try not to send duplicate alerts. Checked for the whole cycle
+            # before storing, otherwise only the first subscriber in an area
+            # would ever hear about an alert.
+            fresh = dict()
+
+            # alert id -> users, so each alert goes out as one payload.
+            audience = defaultdict(list)
+
+            qfilter = {'user': 1, 'same_codes': 1, 'filter': 1}
+            async for sub in db.subscribers.find({}, qfilter):
+                # An alert can cover more than one of their locations.
+                sent = set()
 
-                # Try not to send duplicate alerts.
-                ids = await db.alerts.distinct('properties.id')
+                for location in sub['same_codes']:
+                    for alert in index.get(location, []):
+                        alert_id = alert['properties']['id']
+                        if alert_id in seen or alert_id in sent:
+                            continue
 
-                # Actual processing.
-                for alert in data:
-                    if alert['properties']['id'] not in ids:
-                        db.alerts.insert_one(alert)
+                        sent.add(alert_id)
+
+                        # Remember it so it gets stored after fan out.
+                        fresh[alert_id] = alert
 
                         # PEP8
                         severity = alert['properties']['severity']
 
                         if severity in sub['filter']:
-                            # Easier on the character count.
-                            headline = alert['properties']['headline']
-                            statement = alert['properties']['description']
-
-                            # The horror
-                            logging.info(
-                                '{} for {}'.format(
-                                    headline, sub['user']
-                                )
-                            )
-
-                            # Message payload
-                            payload = {
-                                'to': sub['user'],
-                                'msg': '{}\n\n{}'.format(headline, statement),
-                                'type': 'weather',
-                            }
-
-                            # Pass the infomration to Jarvis.
-                            sock = create_connection(('192.168.1.200', 8888))
-                            sock.send(msgpack.packb(payload))
-                            sock.close()
-
-                    # Release to loop if needed.
-                    await asyncio.sleep(0)
+                            audience[alert_id].append(sub['user'])
+
+                # Release to loop if needed.
+                await asyncio.sleep(0)
+
+            for alert_id, users in audience.items():
+                # Easier on the character count.
+                headline = fresh[alert_id]['properties']['headline']
+                statement = fresh[alert_id]['properties']['description']
+
+                # The horror
+                logging.info('{} for {}'.format(headline, users))
+
+                # Message payload
+                payload = {
+                    'to': users,
+                    'msg': '{}\n\n{}'.format(headline, statement),
+                    'type': 'weather',
+                }
+
+                # Pass the infomration to Jarvis.
+                notify.send(payload)
+
+            for alert in fresh.values():
+                # For the TTL index, Mongo drops it once we'd forget it.
+                alert['expire_at'] = seen._expiry(
+                    alert['properties'].get('expires')
+                )
+                persist.insert('alerts', alert)
+                seen.add(alert)
 
         # 79 character limit...
         logging.debug(
@@ -0,0 +1,93 @@
+'''
+Startup benchmark for JARVIS.
+
+Runs `start.py --bench` a few times and reports, per run, how long after
+the process was spawned the XMPP session started and the first command
+(JARVIS asking itself the time) was answered. Also times a bare
+`import commands` so import regressions show up on their own.
+
+Needs the same config.py as the bot, and a reachable XMPP server.
+
+USAGE: python bench_startup.py [-n RUNS]
+'''
+import sys
+import time
+import threading
+import statistics
+import subprocess
+
+
+def importTime():
+    '''Seconds a fresh interpreter spends on `import commands`.'''
+    code = (
+        'import time; t = time.perf_counter(); import commands; '
+        'print(time.perf_counter() - t)'
+    )
+    out = subprocess.run(
+        [sys.executable, '-c', code], check=True, stdout=subprocess.PIPE
+    )
+    return float(out.stdout)
+
+
+def startTime(timeout=120):
+    '''Spawn the bot once, returns {event: seconds since spawn}.'''
+    spawned = time.monotonic()
+    proc = subprocess.Popen(
+        [sys.executable, '-u', 'start.py', '--bench'],
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+
+    # Don't hang forever if it never gets that far.
+    timer = threading.Timer(timeout, proc.terminate)
+    timer.start()
+
+    timings = dict()
+    try:
+        for line in proc.stdout:
+            # Lines look like: "INFO     BENCH session_start 1.234"
+            if 'BENCH' not in line:
+                continue
+
+            event = line.split()[-2]
+            timings[event] = time.monotonic() - spawned
+
+            if event == 'first_command':
+                break
+    finally:
+        timer.cancel()
+        proc.terminate()
+        proc.wait()
+
+    return timings
+
+
+def summary(name, values):
+    if not values:
+        return '{:<16} no data'.format(name)
+
+    return '{:<16} min {:.3f}s  median {:.3f}s  max {:.3f}s'.format(
+        name, min(values), statistics.median(values), max(values)
+    )
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--runs', type=int, default=5,
+                        help='How many times to start the bot')
+
+    # Parse args.
+    args = parser.parse_args()
+
+    imports = [importTime() for _ in range(args.runs)]
+
+    runs = list()
+    for i in range(args.runs):
+        runs.append(startTime())
+        print('run {}: {}'.format(i + 1, runs[-1]))
+
+    print(summary('import commands', imports))
+    for event in ('session_start', 'first_command'):
+        print(summary(event, [x[event] for x in runs if event in x]))
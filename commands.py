@@ -1,12 +1,29 @@
-import aiohttp
 import logging
 import json
+import time
 import msgpack
 import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import config
-from sympy import solve, simplify, SympifyError
-import arrow
+import schema
+
+
+# Shared pooled HTTP client (web.HTTPClient), start.py hands us this.
+http = None
+
+# Process pool for solve (solver.Solver), also from start.py.
+solver = None
+
+
+def _arrow():
+    '''arrow is slow to import, only pay for it once somebody needs it.'''
+    import arrow
+    return arrow
+
+
+def prewarm():
+    '''Import the heavy stuff ahead of time, meant for a background thread.'''
+    _arrow()
 
 
 async def runREST(httptype, endpoint, payload=None, url=None, headers=None):
@@ -34,30 +51,30 @@ async def runREST(httptype, endpoint, payload=None, url=None, headers=None):
             'Content-Type': 'application/json',
         }
 
-    async with aiohttp.ClientSession() as session:
-        # Build and initiate the request.
-        try:
-            # Hahahahaha
-            if payload is None:
-                req = getattr(session, httptype)
-                async with req(url, headers=headers) as response:
-                    return {
-                        'status': response.status,
-                        'text': await response.text(),
-                        'obj': response,
-                    }
-            else:
-                req = getattr(session, httptype)
-                async with req(url, headers=headers, data=json.dumps(payload)) as response:
-                    return {
-                        'status': response.status,
-                        'text': await response.text(),
-                        'obj': response,
-                    }
-
-        except AttributeError as e:
-            logging.error('Failed to run REST API request..{}'.format(e))
-            return None
+    # Build and initiate the request.
+    try:
+        # Hahahahaha
+        req = getattr(http.session, httptype)
+
+        if payload is None:
+            async with req(url, headers=headers) as response:
+                return {
+                    'status': response.status,
+                    'text': await response.text(),
+                    'obj': response,
+                }
+        else:
+            data = json.dumps(payload)
+            async with req(url, headers=headers, data=data) as response:
+                return {
+                    'status': response.status,
+                    'text': await response.text(),
+                    'obj': response,
+                }
+
+    except AttributeError as e:
+        logging.error('Failed to run REST API request..{}'.format(e))
+        return None
 
 
 async def currentTime(zone=None, *, caller=None):
@@ -67,6 +84,8 @@ async def currentTime(zone=None, *, caller=None):
     USAGE: time
     USAGE: time EST or US/Eastern
     '''
+    arrow = _arrow()
+
     if zone:
         time = {'MST': 'MST7MDT', 'PST': 'PST8PDT', 'CDT': 'CST6CDT'}
 
@@ -90,6 +109,8 @@ async def convertTo(fromTz, toTz, *, caller=None):
     NOTE: Given arguments can be given with the normal version: 'US/Eastern'
     or the shorthand version: 'EST'.
     '''
+    arrow = _arrow()
+
     # Dict of unusual strings of timezones
     time = {'MST': 'MST7MDT', 'PST': 'PST8PDT', 'CDT': 'CST6CDT'}
 
@@ -116,21 +137,22 @@ async def convertTo(fromTz, toTz, *, caller=None):
     return '\n'.join(out)
 
 
-async def currencyExchange(currFrom, currTo, amount=1, *, caller=None):
+class RateCache:
     '''
-    Get the current exchange rate between two currencies.
-
-    USAGE: exchange FROM TO <amount>
-
-    NOTE: parameters in <> are optional and not required.
+    Exchange rates keyed by pair ('USD_EUR'), kept for `ttl` seconds. Pairs
+    that are already being fetched are waited on rather than fetched again,
+    and everything missing is asked for in a single upstream query.
     '''
-    # Check if not empty
-    if currFrom and currTo:
-        currencyF, currencyT = currFrom.upper(), currTo.upper()
-        request = currencyF + '_' + currencyT
+    def __init__(self, *, ttl=600):
+        self.ttl = ttl
+
+        # pair -> (rate, when we got it), and pair -> future being fetched.
+        self.rates = dict()
+        self.inflight = dict()
 
-        tup = ('convert?q=', request, '&compact=y')
-        endpoint = ''.join(tup)
+    async def _fetch(self, pairs):
+        '''One request for every pair, returns {pair: rate}.'''
+        endpoint = 'convert?q={}&compact=y'.format(','.join(pairs))
 
         headers = {
             'User-Agent': 'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS'
@@ -141,19 +163,97 @@ async def currencyExchange(currFrom, currTo, amount=1, *, caller=None):
         # Get API result
         call = await runREST('get', endpoint, None, url, headers)
 
-        if call['status'] == 200:
-            # Decode JSON
-            response = json.loads(call['text'])
+        if call is None or call['status'] != 200:
+            return dict()
+
+        # Decode JSON
+        response = json.loads(call['text'])
+
+        return {
+            pair: float(response[pair]['val'])
+            for pair in pairs if pair in response
+        }
+
+    async def get(self, pairs):
+        '''Rates for every pair we could get, {pair: rate}.'''
+        now = time.monotonic()
+        result, waiting, missing = dict(), dict(), list()
+
+        for pair in dict.fromkeys(pairs):
+            if pair in self.rates and now - self.rates[pair][1] < self.ttl:
+                result[pair] = self.rates[pair][0]
+            elif pair in self.inflight:
+                waiting[pair] = self.inflight[pair]
+            else:
+                missing.append(pair)
+
+        if missing:
+            loop = asyncio.get_event_loop()
+            futures = {pair: loop.create_future() for pair in missing}
+            self.inflight.update(futures)
 
-            rate = response[request]['val']
-            convert = float(amount) * float(rate)
+            fetched = dict()
+            try:
+                fetched = await self._fetch(missing)
+            except Exception as e:
+                logging.error('Exchange rate fetch failed: {}'.format(e))
+            finally:
+                # Even if we're cancelled, whoever is waiting on us must
+                # get an answer, None if we didn't get that far.
+                for pair, future in futures.items():
+                    self.inflight.pop(pair, None)
+                    if pair in fetched:
+                        self.rates[pair] = (fetched[pair], time.monotonic())
+                    if not future.done():
+                        future.set_result(fetched.get(pair))
 
-            out = (
-                f'The rate of {currFrom} to {currTo} is {rate}',
-                f', with {amount}{currFrom.upper()} = {convert}{currTo.upper()}'
-            )
+            result.update(fetched)
 
-            return ''.join(out)
+        for pair, future in waiting.items():
+            # Shielded, us giving up mustn't cancel it for everyone else.
+            rate = await asyncio.shield(future)
+            if rate is not None:
+                result[pair] = rate
+
+        return result
+
+
+# Shared by everyone asking.
+rates = RateCache()
+
+
+async def currencyExchange(currFrom, currTo, amount=1, *, caller=None):
+    '''
+    Get the current exchange rate between two currencies.
+
+    USAGE: exchange FROM TO <amount>
+    USAGE: exchange FROM TO,TO,TO <amount>
+
+    NOTE: parameters in <> are optional and not required.
+    '''
+    # Check if not empty
+    if currFrom and currTo:
+        currencyF = currFrom.upper()
+        targets = [x.upper() for x in currTo.split(',') if x]
+        pairs = ['{}_{}'.format(currencyF, x) for x in targets]
+
+        found = await rates.get(pairs)
+
+        out = list()
+        for currencyT, pair in zip(targets, pairs):
+            if pair not in found:
+                continue
+
+            rate = found[pair]
+            convert = float(amount) * rate
+
+            out.append(''.join((
+                f'The rate of {currencyF} to {currencyT} is {rate}',
+                f', with {amount}{currencyF} = {convert}{currencyT}'
+            )))
+
+        if out:
+            return '\n'.join(out)
 
     return ohSnap(currencyExchange, [currFrom, currTo], caller)
 
@@ -219,6 +319,85 @@ async def toggleWarframe(db, target, *, caller=None):
         return f'Certainly! Will {target} get alerts? {not status}!'
 
 
+async def watchWarframe(db, target, item, *, caller=None):
+    '''
+    Add an item to a user's warframe alert watch list, this also turns
+    their warframe alerts on. Until they watch something they get the
+    Orokin Catalyst/Reactor defaults.
+    USAGE: warframe_watch JID ItemType
+
+    Example: warframe_watch me OrokinCatalystBlueprint
+    '''
+    if target == 'me':
+        target = caller
+
+    if not await db.subscribers.find_one({'user': str(target)}):
+        await addSubscriber(db, target, caller=target)
+
+    # Full ItemType paths are fine too, we only match on the last part.
+    item = str(item).rsplit('/', 1)[-1]
+
+    result = await db.subscribers.update_one(
+        {'user': str(target)},
+        {
+            '$addToSet': {'warframe_watch': item},
+            '$set': {'warframe': True},
+        }
+    )
+
+    if result.modified_count:
+        return 'Watching warframe alerts for {} for {}'.format(item, target)
+
+    # Nothing to change, they were already watching it.
+    if result.matched_count:
+        return '{} is already watching {}.'.format(target, item)
+
+    return ohSnap(watchWarframe, [target, item], caller)
+
+
+async def unwatchWarframe(db, target, item, *, caller=None):
+    '''
+    Remove an item from a user's warframe alert watch list.
+    USAGE: warframe_unwatch JID ItemType
+    '''
+    if target == 'me':
+        target = caller
+
+    item = str(item).rsplit('/', 1)[-1]
+
+    result = await db.subscribers.update_one(
+        {'user': str(target)},
+        {'$pull': {'warframe_watch': item}},
+    )
+
+    if result.modified_count:
+        return 'No longer watching {} for {}'.format(item, target)
+
+    return ohSnap(unwatchWarframe, [target, item], caller)
+
+
+async def listWarframe(db, target, *, caller=None):
+    '''
+    List the warframe alert watch list for the target 'user'.
+    USAGE: warframe_list JID
+    '''
+    if target == 'me':
+        target = caller
+
+    result = await db.subscribers.find_one(
+        {'user': str(target)},
+        {'warframe': 1, 'warframe_watch': 1}
+    )
+
+    if result:
+        watch = result.get('warframe_watch') or ['the defaults']
+        return 'Warframe alerts {} for: {}'.format(
+            'on' if result.get('warframe') else 'off', ', '.join(watch)
+        )
+
+    return ohSnap(listWarframe, [target], caller)
+
+
 async def addSubscriber(db, target, admin=False, *, caller=None):
     '''
     Add a subscriber to my database, really only use for adding a 'template'.
@@ -381,6 +560,31 @@ async def delGitSub(db, target, gituser, gitrepo, *, caller=None):
     return ohSnap(delGitSub, [target, gituser, gitrepo], caller)
 
 
+async def dbReport(db, slowms=100, *, caller=None):
+    '''
+    List the slowest queries Mongo has seen lately, and collection scans
+    where the server records them. Nothing under the profiler's own
+    threshold (100ms) was recorded, so slowms can't go below it.
+    USAGE: db_report <slowms>
+    '''
+    try:
+        slowms = int(slowms)
+    except ValueError:
+        return 'slowms should be a whole number of milliseconds.'
+
+    slowms, lines = await schema.report(db, slowms=slowms)
+
+    if schema.profiler['scans']:
+        title = 'Queries over {}ms or scanning a whole collection:\n'
+    else:
+        title = 'Queries over {}ms:\n'
+
+    if lines:
+        return title.format(slowms) + '\n'.join(lines)
+
+    return 'Nothing slower than {}ms, nice.'.format(slowms)
+
+
 async def registerUser(target, pwd, *, caller=None):
     '''
     Register a user on HIVEs XMPP server.
@@ -463,36 +667,11 @@ async def solveMath(expr, *, caller=None):
     NOTE: no spaces in expression/equation. Operations must be explicit.
     eg. requires 3*x rather than 3x
     '''
-
-    result = None
     if not isinstance(expr, str):
         raise TypeError("Error: solve requires string")
 
-    if '=' in expr:
-        # sympy requires all equations to be equal to 0
-        # so we're gonna juggle numbers and move it all to one side,
-        # removing the = operator.
-        eqindex = expr.index('=')
-
-        # subtracting the whole right side from left side.
-        expr = "{before}-({after})".format(
-            before=expr[:eqindex],
-            after=expr[eqindex + 1:]
-        )
-        try:
-            result = solve(expr)
-        except SympifyError as e:
-            raise SyntaxError(e) from None
-
-    else:  # not an equation, we're going to simplify.
-        try:
-            result = simplify(expr)
-        except SympifyError as e:
-            raise SyntaxError(e) from None
-
-    result = str(result)
-    if 'zoo' in result:
-        result = "ZeroDivisionError"
+    # Off the event loop, sympy can take its sweet time.
+    result = await solver.solve(expr)
 
     if result:
         return 'Here is my solution: {}'.format(result)
@@ -1,8 +1,14 @@
 import asyncio
 import os
+import signal
 import logging
 import importlib.util
 import motor.motor_asyncio
+from datetime import timedelta
+import web
+import notify
+import persist
+import schema
 
 
 # Build a list of functions from the modules in agents folder.
@@ -25,15 +31,34 @@ for name in os.listdir('./agents'):
             runners.append(getattr(module, 'agent'))
 
 
-async def main():
-    client = motor.motor_asyncio.AsyncIOMotorClient()
-    db = client.bot
+async def report(http, *, freq=timedelta(hours=1)):
+    '''Log the shared HTTP pool stats every so often.'''
+    while True:
+        await asyncio.sleep(freq.total_seconds())
+        http.report()
+
+
+async def main(db, writes):
+    # Agents query by these, have them before anyone asks.
+    await schema.ensure(db)
+
+    # One pooled HTTP client for every agent.
+    http = web.HTTPClient()
+
+    # And one connection to Jarvis for all their notifications.
+    notifier = notify.Notifier()
+    asyncio.ensure_future(notifier.run())
 
     # Ensure the future of all our agents.
     for f in runners:
         # Note: just make db an optional paramter if we don't
         # need one for an agent. Currently we do.
-        asyncio.ensure_future(f(db))
+        asyncio.ensure_future(
+            f(db, http=http, notify=notifier, persist=writes)
+        )
+
+    asyncio.ensure_future(report(http))
+    asyncio.ensure_future(writes.run())
 
     # Wait for all to finish before closing up.
     await asyncio.gather(*asyncio.Task.all_tasks())
@@ -57,6 +82,23 @@ if __name__ == '__main__':
         logging.basicConfig(level=logging.INFO,
                             format='%(levelname)-8s %(message)s')
 
+    client = motor.motor_asyncio.AsyncIOMotorClient()
+    db = client.bot
+
+    # Agents buffer their writes here, flushed in bulk.
+    writes = persist.WriteBehind(db)
+
     # Get loop and run main() on it.
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(main())
+    running = asyncio.ensure_future(main(db, writes))
+
+    # SIGTERM is how we normally get stopped, wind down like ^C would.
+    loop.add_signal_handler(signal.SIGTERM, running.cancel)
+
+    try:
+        loop.run_until_complete(running)
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        logging.info('Shutting down..')
+    finally:
+        # Don't lose anything still sitting in the buffer.
+        loop.run_until_complete(writes.close())
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+import msgpack
+from collections import deque
+
+
+class Notifier:
+    '''
+    Keeps a single persistent connection to JARVIS's service listener and
+    pushes payloads over it in batches. Agents just call send(), which never
+    blocks; the actual writing happens in run() on the loop.
+
+    JARVIS answers every batch it accepts with {'ack': n}. Anything not
+    acknowledged when the connection drops gets sent again on the next one.
+    '''
+    def __init__(self, host='192.168.1.200', port=8888, *, batch=64,
+                 linger=0.05, backoff=1, max_backoff=60, maxsize=10000):
+        self.host = host
+        self.port = port
+        self.batch = batch
+        self.linger = linger
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.writer = None
+        self.acks = None
+
+        # Waiting to be written, and written but not acknowledged yet.
+        self.pending = list()
+        self.unacked = deque()
+
+    def send(self, payload):
+        '''Queue a payload for JARVIS. Drops it if we're hopelessly behind.'''
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logging.error('Notifier queue full, dropping: {}'.format(payload))
+
+    async def connect(self):
+        '''Connect, backing off exponentially while JARVIS is unreachable.'''
+        delay = self.backoff
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_connection(
+                    self.host, self.port
+                )
+                self.acks = asyncio.ensure_future(self._read_acks(reader))
+
+                logging.debug('Notifier connected to {}:{}'.format(
+                    self.host, self.port
+                ))
+                return
+
+            except OSError as e:
+                logging.warn('Notifier connect failed ({}), retry in {}s'
+                             .format(e, delay))
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, self.max_backoff)
+
+    async def _read_acks(self, reader):
+        unpacker = msgpack.Unpacker(encoding='utf-8')
+
+        try:
+            while True:
+                chunk = await reader.read(4096)
+                if not chunk:
+                    break
+
+                unpacker.feed(chunk)
+                for ack in unpacker:
+                    for _ in range(min(ack.get('ack', 0), len(self.unacked))):
+                        self.unacked.popleft()
+
+        except (OSError, ValueError, AttributeError) as e:
+            logging.warn('Notifier ack stream broke: {}'.format(e))
+
+        # JARVIS hung up on us, run() will reconnect.
+        logging.warn('Notifier connection closed by JARVIS')
+        self.acks = None
+        self.close()
+
+    async def collect(self):
+        '''Wait for one payload, then grab whatever else shows up shortly.'''
+        batch = [await self.queue.get()]
+
+        await asyncio.sleep(self.linger)
+        while len(batch) < self.batch and not self.queue.empty():
+            batch.append(self.queue.get_nowait())
+
+        return batch
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+        if self.acks is not None:
+            self.acks.cancel()
+            self.acks = None
+
+        # Whatever wasn't acknowledged goes out again, in order.
+        if self.unacked:
+            logging.warn('Notifier resending {} unacknowledged payload(s)'
+                         .format(len(self.unacked)))
+            self.pending = list(self.unacked) + self.pending
+            self.unacked.clear()
+
+    async def run(self):
+        while True:
+            if not self.pending:
+                self.pending.extend(await self.collect())
+
+            if self.writer is None:
+                await self.connect()
+
+            writer = self.writer
+            try:
+                writer.write(b''.join(msgpack.packb(x) for x in self.pending))
+                await writer.drain()
+
+                # Dropped while we were writing, the batch is still pending.
+                if self.writer is not writer:
+                    continue
+
+                logging.debug('Notifier flushed {} payload(s)'.format(
+                    len(self.pending)
+                ))
+                self.unacked.extend(self.pending)
+                self.pending = list()
+
+            except OSError as e:
+                # Keep the batch and try again on a fresh connection.
+                logging.warn('Notifier lost connection: {}'.format(e))
+                self.close()
@@ -0,0 +1,199 @@
+import time
+import heapq
+import asyncio
+import logging
+from itertools import count
+
+
+# Lower goes first. Keyed on the alert_type services send us.
+PRIORITIES = {
+    'weather': 0,
+    'warframe': 1,
+    'git': 2,
+    'sale': 2,
+    'humblebundle': 3,
+}
+DEFAULT_PRIORITY = 2
+
+
+class TokenBucket:
+    '''Classic token bucket, `rate` tokens a second up to `burst`.'''
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait(self):
+        '''Seconds until a token is available, 0 if one is right now.'''
+        self._refill()
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self._refill()
+        self.tokens -= 1
+
+
+class Outbox:
+    '''
+    Outbound chat scheduler. Messages are sent in priority order (see
+    PRIORITIES) while staying under a global rate and a per-recipient rate,
+    so a big free game broadcast can't bury a severe weather alert or get
+    us throttled by the server.
+
+    put() waits while `maxsize` payloads are already queued, which is what
+    pushes back on the service listener. A payload for many users takes one
+    slot, not one per user, so a big broadcast can't keep a later, more
+    important payload stuck on the wire behind it.
+    '''
+    def __init__(self, send, *, rate=5, burst=10, user_rate=0.5,
+                 user_burst=3, maxsize=1000):
+        self.send = send
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+
+        self.bucket = TokenBucket(rate, burst)
+        self.users = dict()
+
+        self.heap = list()
+        self.seq = count()
+        self.slots = asyncio.Semaphore(maxsize)
+        self.ready = asyncio.Event()
+
+        self.counters = {'sent': 0, 'latency': 0.0, 'max_latency': 0.0}
+
+    def __len__(self):
+        return len(self.heap)
+
+    async def put(self, users, msg, alert_type=None):
+        '''Queue `msg` for every one of `users`, one JID or a list.'''
+        if isinstance(users, str):
+            users = [users]
+        if not users:
+            return
+
+        await self.slots.acquire()
+
+        # Users of this payload still to send to, the slot is freed once
+        # it hits 0.
+        left = [len(users)]
+
+        priority = PRIORITIES.get(alert_type, DEFAULT_PRIORITY)
+        queued = time.monotonic()
+        for user in users:
+            heapq.heappush(
+                self.heap,
+                (priority, next(self.seq), queued, user, msg, left)
+            )
+        self.ready.set()
+
+    def _bucket(self, user):
+        if user not in self.users:
+            self.users[user] = TokenBucket(self.user_rate, self.user_burst)
+        return self.users[user]
+
+    def _next(self):
+        '''
+        Pop the most important message whose recipient isn't throttled.
+        Returns (item, None) or (None, seconds until something is ready).
+        '''
+        skipped = list()
+        item, delay = None, None
+
+        while self.heap:
+            candidate = heapq.heappop(self.heap)
+            wait = self._bucket(candidate[3]).wait()
+
+            if wait == 0:
+                item = candidate
+                break
+
+            skipped.append(candidate)
+            delay = wait if delay is None else min(delay, wait)
+
+        for x in skipped:
+            heapq.heappush(self.heap, x)
+
+        return item, delay
+
+    async def run(self):
+        while True:
+            if not self.heap:
+                self.ready.clear()
+                await self.ready.wait()
+
+            # Global limit first, then find someone we're allowed to talk to.
+            wait = self.bucket.wait()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+
+            item, delay = self._next()
+            if item is None:
+                # Everyone queued is throttled, but something new for
+                # someone who isn't shouldn't have to wait on them.
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            priority, seq, queued, user, msg, left = item
+
+            self.bucket.take()
+            self._bucket(user).take()
+
+            left[0] -= 1
+            if not left[0]:
+                self.slots.release()
+
+            try:
+                self.send(user, msg)
+            except Exception as e:
+                logging.error('Failed to send to {}: {}'.format(user, e))
+
+            latency = time.monotonic() - queued
+            self.counters['sent'] += 1
+            self.counters['latency'] += latency
+            self.counters['max_latency'] = max(
+                self.counters['max_latency'], latency
+            )
+
+            # A full bucket is the same as a new one, no need to keep it.
+            if len(self.users) > 1000:
+                self.users = {
+                    k: v for k, v in self.users.items()
+                    if v.wait() or v.tokens < v.burst
+                }
+
+    def stats(self):
+        depth = dict()
+        for x in self.heap:
+            depth[x[0]] = depth.get(x[0], 0) + 1
+
+        sent = self.counters['sent']
+        return {
+            'depth': len(self.heap),
+            'depth_by_priority': depth,
+            'sent': sent,
+            'avg_latency': self.counters['latency'] / sent if sent else 0.0,
+            'max_latency': self.counters['max_latency'],
+        }
+
+    def report(self):
+        stats = self.stats()
+        for k, v in stats.items():
+            if isinstance(v, float):
+                stats[k] = round(v, 3)
+
+        logging.info('Outbox: {}'.format(stats))
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+class WriteBehind:
+    '''
+    Buffers writes nobody needs to wait on (message logs, agent state) and
+    flushes them per collection with one ordered bulk_write, either every
+    `interval` seconds or as soon as a collection has `size` writes queued.
+
+    Writes to the same collection are applied in the order they were
+    queued. Failures are logged, they never reach whoever queued the write.
+    '''
+    def __init__(self, db, *, size=500, interval=5):
+        self.db = db
+        self.size = size
+        self.interval = interval
+
+        # collection name -> list of pending pymongo operations.
+        self.pending = dict()
+        self.lock = asyncio.Lock()
+
+        self.counters = {
+            'queued': 0, 'written': 0, 'flushes': 0, 'errors': 0,
+        }
+
+    def _queue(self, collection, op):
+        ops = self.pending.setdefault(collection, list())
+        ops.append(op)
+        self.counters['queued'] += 1
+
+        if len(ops) >= self.size:
+            asyncio.ensure_future(self.flush())
+
+    def insert(self, collection, doc):
+        self._queue(collection, InsertOne(doc))
+
+    def update(self, collection, query, update, upsert=False):
+        self._queue(collection, UpdateOne(query, update, upsert=upsert))
+
+    async def flush(self):
+        # One flush at a time keeps each collection's writes in order.
+        async with self.lock:
+            pending, self.pending = self.pending, dict()
+
+            for collection, ops in pending.items():
+                try:
+                    result = await self.db[collection].bulk_write(
+                        ops, ordered=True
+                    )
+                    self.counters['written'] += len(ops)
+                    logging.debug('Flushed {} write(s) to {}: {}'.format(
+                        len(ops), collection, result.bulk_api_result
+                    ))
+
+                except BulkWriteError as e:
+                    self.counters['errors'] += len(e.details['writeErrors'])
+                    logging.error('Bulk write to {} failed: {}'.format(
+                        collection, e.details['writeErrors']
+                    ))
+
+                # Anything else, bad documents (InvalidDocument) included,
+                # costs this collection's batch and nothing more.
+                except Exception as e:
+                    self.counters['errors'] += len(ops)
+                    logging.error('Bulk write to {} failed: {}'.format(
+                        collection, e
+                    ))
+
+            self.counters['flushes'] += 1
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.pending:
+                continue
+
+            # Nobody awaits this task, if it dies we'd silently stop
+            # flushing until shutdown.
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception('Write-behind flush failed')
+
+    async def close(self):
+        '''Flush whatever is left, call this on shutdown.'''
+        await self.flush()
+        logging.info('Write-behind closed: {}'.format(self.counters))
@@ -0,0 +1,133 @@
+import re
+import logging
+from pymongo import IndexModel, ASCENDING
+from pymongo.errors import PyMongoError, OperationFailure
+
+
+# Every index we rely on, per collection. create_indexes is a no-op for
+# ones that already exist, so this is safe to run on every boot.
+INDEXES = {
+    'subscribers': [
+        IndexModel([('user', ASCENDING)], name='user'),
+        IndexModel([('admin', ASCENDING)], name='admin'),
+        IndexModel([('warframe', ASCENDING)], name='warframe'),
+    ],
+    'state_data': [
+        IndexModel([('zip', ASCENDING)], name='zip'),
+    ],
+    'git': [
+        IndexModel([('id', ASCENDING)], name='id'),
+    ],
+    'games': [
+        IndexModel(
+            [('human_url', ASCENDING), ('sale_end', ASCENDING)],
+            name='human_url_sale_end'
+        ),
+    ],
+    'warframe': [
+        IndexModel([('id', ASCENDING), ('item', ASCENDING)], name='id_item'),
+        # Stored as local time without a zone, the extra day covers that.
+        IndexModel(
+            [('expires', ASCENDING)], name='expires',
+            expireAfterSeconds=86400
+        ),
+    ],
+    'alerts': [
+        IndexModel([('properties.id', ASCENDING)], name='properties_id'),
+        # expire_at already has the grace period added, see agents.weather.
+        IndexModel(
+            [('expire_at', ASCENDING)], name='expire_at',
+            expireAfterSeconds=0
+        ),
+    ],
+}
+
+
+async def ensure(db):
+    '''
+    Create any missing indexes. A collection that fails (say an index was
+    changed by hand) is logged and skipped, it won't stop the others.
+    '''
+    for collection, indexes in INDEXES.items():
+        try:
+            names = await db[collection].create_indexes(indexes)
+            logging.debug('Indexes on {}: {}'.format(collection, names))
+
+        except PyMongoError as e:
+            logging.error('Creating indexes on {} failed: {}'.format(
+                collection, e
+            ))
+
+
+# What the profiler was told to record, see profile(). report() can't
+# show anything the profiler never wrote down.
+profiler = {'slowms': 100, 'scans': False}
+
+
+async def profile(db, slowms=100):
+    '''
+    Have Mongo record anything slower than `slowms` in system.profile, and
+    every collection scan however quick where the server supports a
+    profiler filter (4.4.2+).
+    '''
+    scans = {'$or': [
+        {'millis': {'$gte': slowms}},
+        {'planSummary': 'COLLSCAN'},
+    ]}
+
+    try:
+        try:
+            await db.command('profile', 1, slowms=slowms, filter=scans)
+            profiler['scans'] = True
+        except OperationFailure:
+            # Older server, slow operations only.
+            await db.command('profile', 1, slowms=slowms)
+            profiler['scans'] = False
+
+        profiler['slowms'] = slowms
+
+    except PyMongoError as e:
+        logging.warn('Could not enable profiling: {}'.format(e))
+
+
+async def report(db, slowms=100, limit=10):
+    '''
+    Summarize system.profile: the slowest query shapes that took at least
+    `slowms`, and any collection scans if the profiler records those,
+    worst first. `slowms` below the profiler's own threshold is raised to
+    it, those never made it into system.profile.
+
+    Returns the `slowms` actually used and the summary lines.
+    '''
+    slowms = max(slowms, profiler['slowms'])
+
+    wanted = [{'millis': {'$gte': slowms}}]
+    if profiler['scans']:
+        wanted.append({'planSummary': 'COLLSCAN'})
+
+    pipeline = [
+        {'$match': {
+            # A compiled pattern, older servers reject $not with $regex.
+            'ns': {'$not': re.compile(r'\.system\.')},
+            '$or': wanted,
+        }},
+        {'$group': {
+            '_id': {'ns': '$ns', 'op': '$op', 'plan': '$planSummary'},
+            'count': {'$sum': 1},
+            'avg': {'$avg': '$millis'},
+            'max': {'$max': '$millis'},
+        }},
+        {'$sort': {'max': -1}},
+        {'$limit': limit},
+    ]
+
+    lines = list()
+    async for x in db['system.profile'].aggregate(pipeline):
+        lines.append('{ns} {op} {plan}: {count}x, avg {avg:.0f}ms, '
+                     'max {max}ms'.format(
+                         count=x['count'], avg=x['avg'] or 0, max=x['max'],
+                         plan=x['_id'].get('plan', 'n/a'),
+                         ns=x['_id'].get('ns'), op=x['_id'].get('op'),
+                     ))
+
+    return slowms, lines
@@ -0,0 +1,173 @@
+import signal
+import multiprocessing
+import asyncio
+import logging
+import resource
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+
+class SolveTimeout(Exception):
+    '''A job used up its CPU time inside the worker.'''
+
+
+def _cpu_exceeded(signum, frame):
+    raise SolveTimeout('CPU time limit exceeded')
+
+
+def _warm():
+    '''Runs once in each worker, so sympy is already loaded for jobs.'''
+    import sympy  # noqa: F401
+
+    # SIGXCPU would kill the worker outright, we'd rather just fail the job.
+    signal.signal(signal.SIGXCPU, _cpu_exceeded)
+
+
+def _ping():
+    return True
+
+
+def _solve(expr, cpu_limit):
+    '''
+    The actual sympy work, run inside a worker process. The RLIMIT_CPU soft
+    limit is moved to `cpu_limit` seconds past what this worker has used so
+    far and put back afterwards.
+    '''
+    from sympy import solve, simplify, SympifyError
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = int(usage.ru_utime + usage.ru_stime) + 1
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    limit = used + cpu_limit
+    if hard != resource.RLIM_INFINITY:
+        limit = min(limit, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (limit, hard))
+
+    try:
+        if '=' in expr:
+            # sympy requires all equations to be equal to 0
+            # so we're gonna juggle numbers and move it all to one side,
+            # removing the = operator.
+            eqindex = expr.index('=')
+
+            # subtracting the whole right side from left side.
+            expr = "{before}-({after})".format(
+                before=expr[:eqindex],
+                after=expr[eqindex + 1:]
+            )
+            try:
+                result = solve(expr)
+            except SympifyError as e:
+                raise SyntaxError(str(e)) from None
+
+        else:  # not an equation, we're going to simplify.
+            try:
+                result = simplify(expr)
+            except SympifyError as e:
+                raise SyntaxError(str(e)) from None
+
+    finally:
+        resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+    result = str(result)
+    if 'zoo' in result:
+        result = "ZeroDivisionError"
+
+    return result
+
+
+class Solver:
+    '''
+    Runs sympy in a pool of warm worker processes so a nasty expression
+    can't freeze the bot. Each job gets `cpu_limit` seconds of CPU, and if
+    a job still hasn't come back after `timeout` seconds the pool is torn
+    down and replaced. Answers are kept in a small LRU cache.
+    '''
+    def __init__(self, *, workers=2, cpu_limit=5, timeout=10,
+                 cache_size=256):
+        self.workers = workers
+        self.cpu_limit = cpu_limit
+        self.timeout = timeout
+        self.cache_size = cache_size
+
+        self.cache = OrderedDict()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            # Workers come from a clean forkserver, never a fork of the bot
+            # itself which may be holding import locks or running threads.
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=_warm,
+                mp_context=multiprocessing.get_context('forkserver'),
+            )
+        return self._executor
+
+    def warm(self):
+        '''Start the workers now rather than on the first solve.'''
+        for _ in range(self.workers):
+            self.executor.submit(_ping)
+
+    def _kill(self, executor):
+        '''
+        Cancel whatever is running by taking `executor` down. Only if it's
+        still the current pool, jobs stranded on an old one shouldn't take
+        out its replacement.
+        '''
+        if executor is None or self._executor is not executor:
+            return
+
+        # ProcessPoolExecutor can't cancel a running job, and shutdown()
+        # waits for it, so terminate the workers ourselves. _processes is
+        # private, hence the getattr in case it ever goes away.
+        processes = getattr(executor, '_processes', None) or dict()
+        for process in list(processes.values()):
+            process.terminate()
+
+        executor.shutdown(wait=False)
+        self._executor = None
+
+    async def solve(self, expr):
+        # Spaces don't change the maths, don't let them miss the cache.
+        key = ''.join(expr.split())
+
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+
+        # Remember which pool this went to, it may be replaced meanwhile.
+        executor = self.executor
+
+        loop = asyncio.get_event_loop()
+        job = loop.run_in_executor(executor, _solve, key, self.cpu_limit)
+
+        # Failures come back as SyntaxError, which JARVIS replies with.
+        try:
+            result = await asyncio.wait_for(job, self.timeout)
+
+        except SolveTimeout:
+            raise SyntaxError('That took too long, I gave up.') from None
+
+        except asyncio.TimeoutError:
+            logging.warning('solve({}) timed out, restarting pool'.format(key))
+            self._kill(executor)
+            raise SyntaxError('That took too long, I gave up.') from None
+
+        except BrokenProcessPool:
+            logging.error('Solver pool died, restarting it')
+            self._kill(executor)
+            raise SyntaxError('Something broke, try again?') from None
+
+        self.cache[key] = result
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+        return result
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
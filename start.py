@@ -1,54 +1,168 @@
-import motor.motor_asyncio
-import commands
-import slixmpp
-import logging
-import asyncio
-import msgpack
-from inspect import signature
-from functools import partial
-from datetime import datetime
-import config
+import time
+
+# As close to process start as we can get, for the startup timings.
+BOOT = time.monotonic()
+
+import motor.motor_asyncio  # noqa: E402
+import commands  # noqa: E402
+import web  # noqa: E402
+import outbox  # noqa: E402
+import persist  # noqa: E402
+import schema  # noqa: E402
+import solver  # noqa: E402
+import signal  # noqa: E402
+import slixmpp  # noqa: E402
+import logging  # noqa: E402
+import asyncio  # noqa: E402
+import msgpack  # noqa: E402
+from inspect import signature  # noqa: E402
+from datetime import datetime, timedelta  # noqa: E402
+import config  # noqa: E402
+
+
+# What --bench sends itself to time a command end to end.
+BENCH_PROBE = 'time'
+
+
+class Command:
+    '''
+    A chat command, with what message() needs to know about it worked out
+    once up front instead of on every message.
+    '''
+    def __init__(self, func, *, admin=True, admins=False):
+        self.func = func
+        self.help = func.__doc__
+
+        # Admin only? And does running it change who the admins are?
+        self.admin = admin
+        self.admins = admins
+
+        params = signature(func).parameters.values()
+        positional = [
+            p for p in params
+            if p.kind in (p.POSITIONAL_ONLY, p.POSITIONAL_OR_KEYWORD)
+        ]
+
+        # Does it want the db handed to it?
+        self.db = any(p.name == 'db' for p in positional)
+        if self.db:
+            positional = [p for p in positional if p.name != 'db']
+
+        # How many words it takes after the command itself.
+        self.min_args = sum(1 for p in positional if p.default is p.empty)
+        self.max_args = len(positional)
+        if any(p.kind == p.VAR_POSITIONAL for p in params):
+            self.max_args = None
+
+    def accepts(self, count):
+        if count < self.min_args:
+            return False
+
+        return self.max_args is None or count <= self.max_args
 
 
 class JARVIS(slixmpp.ClientXMPP):
-    def __init__(self, jid, password):
+    def __init__(self, jid, password, *, bench=False):
         slixmpp.ClientXMPP.__init__(self, jid, password)
 
+        # Startup benchmark mode, see bench_startup.py.
+        self.bench = bench
+        self.first_command = None
+
         self.add_event_handler('session_start', self.start)
         self.add_event_handler('changed_status', self.status_handler)
         self.add_event_handler('message', self.message)
 
-        # Commands available for use, with help strings.
+        # Commands available for use, with help strings. Anything not
+        # marked admin=False is admin only.
         self.commands = {
-            'register_user': commands.registerUser,
-            'delete_user': commands.deleteUser,
-            'update_user': commands.updateUser,
-            'add_sub': commands.addSubscriber,
-            'del_sub': commands.deleteSubscriber,
-            'add_git': commands.addGitSub,
-            'del_git': commands.delGitSub,
-            'solve': commands.solveMath,
-            'add_alert': commands.addWeatherSub,
-            'time': commands.currentTime,
-            'tz': commands.convertTo,
-            'exchange': commands.currencyExchange,
-            'salewatch': commands.addSaleWatch,
-            'del_alert': commands.delWeatherSub,
-            'list_alerts': commands.listWeatherSub,
-            'togglewarframe': commands.toggleWarframe,
+            'register_user': Command(commands.registerUser),
+            'delete_user': Command(commands.deleteUser),
+            'update_user': Command(commands.updateUser),
+            'add_sub': Command(commands.addSubscriber, admins=True),
+            'del_sub': Command(commands.deleteSubscriber, admins=True),
+            'add_git': Command(commands.addGitSub),
+            'del_git': Command(commands.delGitSub),
+            'solve': Command(commands.solveMath, admin=False),
+            'add_alert': Command(commands.addWeatherSub),
+            'time': Command(commands.currentTime, admin=False),
+            'tz': Command(commands.convertTo, admin=False),
+            'exchange': Command(commands.currencyExchange, admin=False),
+            'salewatch': Command(commands.addSaleWatch),
+            'del_alert': Command(commands.delWeatherSub),
+            'list_alerts': Command(commands.listWeatherSub),
+            'db_report': Command(commands.dbReport),
+            'togglewarframe': Command(commands.toggleWarframe),
+            'warframe_watch': Command(commands.watchWarframe),
+            'warframe_unwatch': Command(commands.unwatchWarframe),
+            'warframe_list': Command(commands.listWarframe),
         }
 
+        # Built once, it's only the docstrings.
+        self.help = ''.join(
+            ['My available commands (try \'me\' as target!):\n'] +
+            ['{0}\n{1}\n'.format(k, v.help) for k, v in self.commands.items()]
+        )
+
         # Get a mongodb client and db
         client = motor.motor_asyncio.AsyncIOMotorClient()
         self.db = client.bot
 
+        # Make sure the indexes are there, and note slow queries for
+        # db_report. Neither needs to hold up logging in.
+        asyncio.ensure_future(schema.ensure(self.db), loop=self.loop)
+        asyncio.ensure_future(schema.profile(self.db), loop=self.loop)
+
+        # Buffered writes for things we don't need to wait on.
+        self.persist = persist.WriteBehind(self.db)
+        asyncio.ensure_future(self.persist.run(), loop=self.loop)
+
         # Simple dictionary to note who is busy.
         self.busy = dict()
 
+        # Admin JIDs, cached so we don't ask Mongo on every message.
+        self.admins = set()
+        self.refresher = None
+
+        # Named audiences services can address instead of a JID.
+        self.audiences = {
+            'all_friends': self._friends,
+        }
+
+        # Outbound chat messages, prioritized and rate limited. Bounded so
+        # service producers get pushed back on (see handle_serviceMessage)
+        # instead of piling up here.
+        self.outbox = outbox.Outbox(self._send)
+        asyncio.ensure_future(self.outbox.run(), loop=self.loop)
+        asyncio.ensure_future(self._report(), loop=self.loop)
+
     async def start(self, event):
+        logging.info('BENCH session_start {:.3f}'.format(
+            time.monotonic() - BOOT
+        ))
+
         self.send_presence()
         self.get_roster()
 
+        await self.loadAdmins()
+
+        # Now that we're talking, load the slow stuff in the background so
+        # the first solve/time doesn't pay for it. Pool first, so nothing is
+        # halfway through an import when its workers start.
+        commands.solver.warm()
+        self.loop.run_in_executor(None, commands.prewarm)
+
+        # Time a real command end to end by asking ourselves the time.
+        if self.bench:
+            self.send_message(
+                mto=self.boundjid.full, mtype='chat', mbody=BENCH_PROBE
+            )
+
+        # Catch admin changes made straight in the DB. Only once, this
+        # fires again on every reconnect.
+        if self.refresher is None:
+            self.refresher = asyncio.ensure_future(self._refreshAdmins())
+
     async def status_handler(self, pres):
         '''Handle the busy list via status changes.'''
         who = pres['from'].bare
@@ -74,29 +188,95 @@ class JARVIS(slixmpp.ClientXMPP):
 
         logging.debug('Status of busy list: {}'.format(self.busy))
 
-    async def notifyUser(self, user, msg, alert_type):
-        '''Simple helper method for me.'''
-        if user not in self.busy:
-            self.send_message(
-                mto=user,
-                mtype='chat',
-                mbody=msg,
-            )
-        else:
-            self.busy[user][alert_type] = msg
+    async def notifyUsers(self, users, msg, alert_type):
+        '''Simple helper method for me. Waits if the outbox is full.'''
+        ready = list()
+        for user in users:
+            if user in self.busy:
+                self.busy[user][alert_type] = msg
+            else:
+                ready.append(user)
 
-    async def _isAdmin(self, user):
-        # Async List Comprehensions and PEP8 formatting
-        admin = [
-            x['user'] async for x in self.db.subscribers.find({'admin': True})
+        # The whole payload goes in at once, it's one slot in the outbox.
+        await self.outbox.put(ready, msg, alert_type)
+
+    def _send(self, user, msg):
+        '''What the outbox calls once a message is allowed out.'''
+        self.send_message(
+            mto=user,
+            mtype='chat',
+            mbody=msg,
+        )
+
+    async def _report(self, *, freq=timedelta(hours=1)):
+        '''Log how the outbox and HTTP pool are doing every so often.'''
+        while True:
+            await asyncio.sleep(freq.total_seconds())
+            self.outbox.report()
+
+            if commands.http is not None:
+                commands.http.report()
+
+    async def _friends(self):
+        '''Everyone who is mutual friends with Jarvis.'''
+        # This should be a dictionary and it's not. Why?
+        # Come on library developer :(
+        return [
+            friend for friend in self.client_roster
+            if self.client_roster[friend]['subscription'] == 'both'
         ]
 
+    async def recipients(self, to):
+        '''Expand the 'to' field of a service payload into JIDs.'''
+        if isinstance(to, (list, tuple)):
+            # Don't message anyone twice for the same thing.
+            return list(dict.fromkeys(to))
+
+        if to in self.audiences:
+            return await self.audiences[to]()
+
+        return [to]
+
+    def firstCommand(self):
+        self.first_command = time.monotonic() - BOOT
+        logging.info('BENCH first_command {:.3f}'.format(self.first_command))
+
+        if self.bench:
+            self.disconnect()
+
+    async def loadAdmins(self):
+        '''(Re)load the admin set from the DB.'''
+        # Async List Comprehensions and PEP8 formatting
+        self.admins = {
+            x['user'] async for x in
+            self.db.subscribers.find({'admin': True}, {'user': 1})
+        }
+
+        logging.debug('Loaded {} admin(s)'.format(len(self.admins)))
+
+    async def _refreshAdmins(self, *, freq=timedelta(minutes=10)):
+        while True:
+            await asyncio.sleep(freq.total_seconds())
+            await self.loadAdmins()
+
+    def _isAdmin(self, user):
         # Are they an admin?
-        return user in admin
+        return user in self.admins
 
     async def message(self, msg):
+        # Never talk to ourselves. Benchmarking only lets its own probe
+        # through, once, our replies to it would just bounce back forever.
+        if msg['from'].bare == self.boundjid.bare:
+            probe = self.bench and self.first_command is None
+            if not probe or msg['body'] != BENCH_PROBE:
+                return
+
         # huehue
-        (cmd, args) = (msg['body'].split()[0].lower(), msg['body'].split()[1:])
+        parts = msg['body'].split()
+        if not parts:
+            return
+
+        (cmd, args) = (parts[0].lower(), parts[1:])
         logging.debug('Parsed message: {0}'.format((cmd, args)))
 
         # It's XML by default, but translates okay to a dict so we do that
@@ -112,44 +292,51 @@ class JARVIS(slixmpp.ClientXMPP):
         casted_msg['from'] = str(casted_msg['from'])
         casted_msg['date'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # Store it.
-        await self.db.messages.insert_one(casted_msg)
+        # Store it, whenever. Nobody is waiting on the log.
+        self.persist.insert('messages', casted_msg)
+
+        user = msg['from'].bare
+        command = self.commands.get(cmd)
 
         # Command processing.
         try:
-            # The commands non-admin can run..
-            safeCommands = ('solve', 'help', 'time', 'tz', 'exchange')
+            if command is None:
+                if cmd == 'help' or self._isAdmin(user):
+                    msg.reply(self.help).send()
+                else:
+                    msg.reply('Invalid permissions for that command.').send()
 
             # Command logic.
-            if await self._isAdmin(msg['from'].bare) or cmd in safeCommands:
-                # Wrap the method to reduce character count because
-                # we are sinners.
-                func = partial(self.commands[cmd], caller=msg['from'].bare)
-
-                # Honestly not acceptable. I'm creating bloat.
-                params = signature(self.commands[cmd]).parameters
+            elif not command.admin or self._isAdmin(user):
+                # Tell them how to use it.
+                if not command.accepts(len(args)):
+                    msg.reply(command.help).send()
+                    return
 
-                if 'db' in params.keys():
-                    resp = await func(self.db, *args)
-                    msg.reply(resp).send()
+                if command.db:
+                    resp = await command.func(self.db, *args, caller=user)
                 else:
-                    resp = await func(*args)
-                    msg.reply(resp).send()
+                    resp = await command.func(*args, caller=user)
+
+                msg.reply(resp).send()
+
+                # These can change who is an admin.
+                if command.admins:
+                    await self.loadAdmins()
+
+                if self.first_command is None:
+                    self.firstCommand()
 
             else:
                 msg.reply('Invalid permissions for that command.').send()
 
         except (KeyError, SyntaxError, TypeError) as e:
             if type(e).__name__ == 'KeyError':
-                end = 'My available commands (try \'me\' as target!):\n'
-                for k, v in self.commands.items():
-                    end += '{0}\n{1}\n'.format(k, v.__doc__)
-
-                msg.reply(end).send()
+                msg.reply(self.help).send()
 
             elif type(e).__name__ == 'TypeError':
                 # Tell them how to use it.
-                msg.reply(self.commands[cmd].__doc__).send()
+                msg.reply(command.help).send()
 
             else:
                 # Actual command failure
@@ -159,55 +346,84 @@ class JARVIS(slixmpp.ClientXMPP):
 async def handle_serviceMessage(reader, writer):
     '''
     This handles the messages sent from other scripts and services
-    on the network that only use JARVIS to send a message. Pretty simple.
+    on the network that only use JARVIS to send a message. Connections
+    can stay open and send any number of msgpack payloads back to back.
+
+    After each batch we've read we answer with {'ack': n}, n being how many
+    payloads were accepted. We don't read the next batch until the outbox
+    has room for this one, so a busy JARVIS slows producers down through
+    plain TCP backpressure.
     '''
-    data = await reader.read()
     addr = writer.get_extra_info('peername')
+    unpacker = msgpack.Unpacker(encoding='utf-8')
 
-    # Just to be sure...
-    writer.close()
-
-    # Unpack the data
+    # Unpack the data as it arrives.
     try:
-        if len(data) > 0:
-            data = msgpack.unpackb(data, encoding='utf-8')
-
-            # Just for logs.
-            logging.warn('msg from: {}, to: {}, type: {}'.format(
-                addr[0],
-                data['to'],
-                data.get('type'),
-            ))
-
-            if data['to'] == 'all_friends':
-                # This should be a dictionary and it's not. Why?
-                # Come on library developer :(
-                for friend in xmpp.client_roster:
-                    subtype = xmpp.client_roster[friend]['subscription']
-
-                    # If they aren't mutual friends with Jarvis, skip
-                    if subtype != 'both':
-                        continue
-
-                    await xmpp.notifyUser(
-                        friend,
-                        data['msg'],
-                        alert_type=data.get('type')
-                    )
+        while True:
+            chunk = await reader.read(65536)
+            if not chunk:
+                break
 
-            else:
-                await xmpp.notifyUser(
-                    data['to'],
-                    data['msg'],
-                    alert_type=data.get('type')
-                )
-
-    except msgpack.exceptions.UnpackValueError as e:
-        # Something went wrong, likely an empty message.
+            unpacker.feed(chunk)
+
+            accepted = 0
+            for data in unpacker:
+                await handle_payload(addr, data)
+                accepted += 1
+
+            if accepted:
+                writer.write(msgpack.packb({'ack': accepted}))
+                await writer.drain()
+
+    except ValueError as e:
+        # Something went wrong, garbage on the wire.
         logging.error('Failed to unpack: {}'.format(e))
 
+    except ConnectionError as e:
+        logging.warn('Service connection from {} lost: {}'.format(addr, e))
+
+    finally:
+        writer.close()
+
+
+async def handle_payload(addr, data):
+    '''
+    Deliver a single unpacked service payload. 'to' can be a JID, a list
+    of JIDs or the name of an audience we expand here (see JARVIS.audiences).
+    '''
+    # One bad producer shouldn't take the whole connection down.
+    if not isinstance(data, dict) or 'to' not in data or 'msg' not in data:
+        logging.error('Malformed payload from {}: {}'.format(addr[0], data))
+        return
+
+    recipients = await xmpp.recipients(data['to'])
+
+    # Just for logs.
+    logging.warn('msg from: {}, to: {} ({} recipients), type: {}'.format(
+        addr[0],
+        data['to'] if isinstance(data['to'], str) else 'list',
+        len(recipients),
+        data.get('type'),
+    ))
+
+    await xmpp.notifyUsers(
+        recipients,
+        data['msg'],
+        alert_type=data.get('type')
+    )
+
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--bench', action='store_true',
+                        help='Log startup timings and quit after the '
+                        'first command')
+
+    # Parse args.
+    args = parser.parse_args()
+
     # Setup logging.
     logging.basicConfig(level=logging.INFO,
                         format='%(levelname)-8s %(message)s')
@@ -216,18 +432,38 @@ if __name__ == '__main__':
     xmpp = JARVIS(
         config.xmpp_user,
         config.xmpp_pass,
+        bench=args.bench,
     )
 
-    # Add a TCP listener to the bots loop.
-    xmpp.loop.run_until_complete(
-        asyncio.start_server(
-            handle_serviceMessage, '192.168.1.200', 8888
+    # Commands share one pooled HTTP client.
+    commands.http = web.HTTPClient()
+
+    # And solve runs in its own worker processes.
+    commands.solver = solver.Solver()
+
+    # Add a TCP listener to the bots loop. Not while benchmarking, so that
+    # can run next to the real thing.
+    if not args.bench:
+        xmpp.loop.run_until_complete(
+            asyncio.start_server(
+                handle_serviceMessage, '192.168.1.200', 8888
+            )
         )
-    )
 
     # Register some plugins.
     xmpp.register_plugin('xep_0199')  # XMPP Ping
 
+    # SIGTERM is how we normally get stopped, stop the loop so the finally
+    # below still gets to flush.
+    xmpp.loop.add_signal_handler(signal.SIGTERM, xmpp.loop.stop)
+
     # Connect and run the loop.
     xmpp.connect()
-    xmpp.process()
+    try:
+        xmpp.process(forever=not args.bench)
+    except KeyboardInterrupt:
+        logging.info('Shutting down..')
+    finally:
+        # Don't lose anything still sitting in the buffer.
+        xmpp.loop.run_until_complete(xmpp.persist.close())
+        commands.solver.close()
@@ -0,0 +1,134 @@
+import time
+import logging
+import aiohttp
+
+
+class HTTPClient:
+    '''
+    One pooled aiohttp session for the whole process. Connections are kept
+    alive and reused, DNS lookups are cached and every request gets a
+    default timeout unless it asks for its own.
+
+    The session is created lazily so this can be built outside of a
+    running loop (aiohttp complains otherwise).
+    '''
+    def __init__(self, *, limit=100, limit_per_host=8, dns_ttl=300,
+                 keepalive=30, timeout=60):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.dns_ttl = dns_ttl
+        self.keepalive = keepalive
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+
+        self._session = None
+
+        # Pool statistics, filled in by the trace hooks below.
+        self.counters = {
+            'requests': 0,
+            'created': 0,
+            'reused': 0,
+            'queued': 0,
+            'queue_wait': 0.0,
+            'dns_hits': 0,
+            'dns_misses': 0,
+        }
+
+    def _tracer(self):
+        trace = aiohttp.TraceConfig()
+
+        async def request_start(session, ctx, params):
+            self.counters['requests'] += 1
+
+        async def queued_start(session, ctx, params):
+            ctx.queued = time.monotonic()
+
+        async def queued_end(session, ctx, params):
+            self.counters['queued'] += 1
+            self.counters['queue_wait'] += time.monotonic() - ctx.queued
+
+        async def created(session, ctx, params):
+            self.counters['created'] += 1
+
+        async def reused(session, ctx, params):
+            self.counters['reused'] += 1
+
+        async def dns_hit(session, ctx, params):
+            self.counters['dns_hits'] += 1
+
+        async def dns_miss(session, ctx, params):
+            self.counters['dns_misses'] += 1
+
+        trace.on_request_start.append(request_start)
+        trace.on_connection_queued_start.append(queued_start)
+        trace.on_connection_queued_end.append(queued_end)
+        trace.on_connection_create_end.append(created)
+        trace.on_connection_reuseconn.append(reused)
+        trace.on_dns_cache_hit.append(dns_hit)
+        trace.on_dns_cache_miss.append(dns_miss)
+
+        return trace
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                use_dns_cache=True,
+                ttl_dns_cache=self.dns_ttl,
+                keepalive_timeout=self.keepalive,
+            )
+
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=self.timeout,
+                trace_configs=[self._tracer()],
+                headers={
+                    'User-Agent':
+                    'JARVIS/v2 (https://github.com/PatchesPrime/JARVIS)',
+                },
+            )
+
+        return self._session
+
+    def request(self, method, url, **kwargs):
+        '''Same as ClientSession.request, use it with async with.'''
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.session.get(url, **kwargs)
+
+    def stats(self):
+        '''Snapshot of how the pool is doing.'''
+        stats = dict(self.counters)
+
+        connections = stats['created'] + stats['reused']
+        stats['reuse_ratio'] = 0.0
+        if connections:
+            stats['reuse_ratio'] = stats['reused'] / connections
+
+        stats['avg_queue_wait'] = 0.0
+        if stats['queued']:
+            stats['avg_queue_wait'] = stats['queue_wait'] / stats['queued']
+
+        # Idle keep-alive connections plus the ones currently in use. The
+        # connector doesn't expose these publicly.
+        stats['open'] = 0
+        if self._session is not None and not self._session.closed:
+            connector = self._session.connector
+            idle = sum(len(x) for x in connector._conns.values())
+            stats['open'] = idle + len(connector._acquired)
+
+        return stats
+
+    def report(self):
+        stats = self.stats()
+        for k, v in stats.items():
+            if isinstance(v, float):
+                stats[k] = round(v, 3)
+
+        logging.info('HTTP pool: {}'.format(stats))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()